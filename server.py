@@ -4,10 +4,14 @@
 
 # Twisted - networking library
 from twisted.internet.protocol import ServerFactory, ClientCreator, DatagramProtocol
-from twisted.protocols.basic import LineReceiver
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver, FileSender
 from twisted.protocols.policies import TimeoutMixin
 from twisted.internet.task import LoopingCall
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads, error
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 
 # Other
 import argparse
@@ -16,14 +20,138 @@ import sys
 import errno
 import time
 import re
-import shelve  # For writing out dictionary
+import shelve  # For reading logs from older versions
+import struct
+import zlib
+import glob
+import bisect
+import itertools
+import binascii
 import shutil  # For file copy
 import hashlib
 import json
-import copy
+import collections
+from cStringIO import StringIO  # Files served from the read cache
+from multiprocessing.dummy import Pool as HashPool  # Threads, not processes
+
+# Algorithms for file hashes.  BLAKE2 needs the optional pyblake2 package.
+hash_algorithms = dict([(name, getattr(hashlib, name))
+                        for name in hashlib.algorithms])
+try:
+    import pyblake2
+    hash_algorithms['blake2b'] = pyblake2.blake2b
+    hash_algorithms['blake2s'] = pyblake2.blake2s
+except ImportError:
+    pass
 
 verbosity = 0
 
+def readExtents(path, extents, chunk_size=64*1024):
+    """ Yields the (offset, length) extents of path, a chunk at a time. """
+    with open(path, 'rb') as f:
+        for (offset, length) in extents:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(chunk_size, length))
+                if not chunk:
+                    raise IOError("%s is shorter than expected" % path)
+                length -= len(chunk)
+                yield chunk
+
+def hashFile(path, algorithm, block_size=2**20):
+    """ Returns a hasher fed the contents of path, read a block at a time. """
+    # from http://stackoverflow.com/questions/1131220/get-md5-hash-of-a-files-without-open-it-in-python
+    h = hash_algorithms[algorithm]()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            h.update(data)
+    return h
+
+def blockSums(path, algorithm, block_size):
+    """
+    Returns [weak, strong] checksums of each block of path, for delta sync:
+    adler32, then a hex digest checked only when the adler32 matches.
+    """
+    blocks = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            blocks.append([zlib.adler32(data) & 0xffffffff,
+                           hash_algorithms[algorithm](data).hexdigest()])
+    return blocks
+
+def fileDelta(path, blocks, algorithm, block_size, size=None,
+              other_size=None):
+    """
+    Compares the first size bytes of path (all of it if None) with another
+    copy's blockSums.  Returns the (offset, length) ranges of path that copy
+    lacks, adjacent ranges merged.  Files only grow by appending, so blocks
+    are compared where they line up.  Given the copy's size, its short last
+    block is compared with the start of the block here, so only what was
+    appended after it is sent.
+    """
+    ranges = []
+    def lacks(offset, length):
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+    with open(path, 'rb') as f:
+        i = 0
+        offset = 0
+        while size is None or offset < size:
+            data = f.read(block_size if size is None
+                          else min(block_size, size - offset))
+            if not data:
+                break
+            have = len(data)  # Bytes of this block the copy may have
+            if other_size is not None:
+                have = min(have, max(0, other_size - offset))
+            same = (i < len(blocks) and have > 0 and
+                    zlib.adler32(data[:have]) & 0xffffffff == blocks[i][0] and
+                    hash_algorithms[algorithm](data[:have]).hexdigest() ==
+                    blocks[i][1])
+            if not same:
+                lacks(offset, len(data))
+            elif have < len(data):
+                lacks(offset + have, len(data) - have)
+            offset += len(data)
+            i += 1
+    return ranges
+
+def splitBatch(buf):
+    """
+    Splits the body of a WRITE_BATCH into its (seq, data) writes.  Each is
+    a line "seq length", then length bytes of data.
+    """
+    writes = []
+    start = 0
+    while start < len(buf):
+        end = buf.find('\r\n', start)
+        if end < 0:
+            raise Exception(204, "Batch entry is missing its data.")
+        try:
+            (seq, length) = map(int, buf[start:end].split())
+        except ValueError:
+            raise Exception(204, "Batch entry must start with a sequence number and length.")
+        start = end + 2
+        if seq < 0 or length < 0 or start + length > len(buf):
+            raise Exception(204, "Batch entry is longer than the message.")
+        writes.append((seq, buf[start:start + length]))
+        start += length
+    return writes
+
+def toBytes(s):
+    """ JSON gives back unicode strings, but the log and files want bytes. """
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Run a replicated fileserver.')
     parser.add_argument('-ip', default='127.0.0.1',
@@ -34,6 +162,60 @@ def parse_args():
                         help='Directory to store files in.  Required.')
     parser.add_argument('-primary','-p', required=True,
                         help='Absolute path to primary.txt file.  Required.')
+    parser.add_argument('-group-commit', default=0, type=float,
+                        help="Share one log fsync between records appended "
+                        "within this many seconds.  Defaults to 0 (fsync "
+                        "every record)")
+    parser.add_argument('-group-commit-max', default=64, type=int,
+                        help="Fsync a group early once it holds this many "
+                        "records.  Defaults to 64")
+    parser.add_argument('-commit-threads', default=4, type=int,
+                        help="Number of threads writing commits to files.  "
+                        "Defaults to 4")
+    parser.add_argument('-commit-mode', default='copy',
+                        choices=['copy', 'append'],
+                        help="copy writes a commit to a copy of the file and "
+                        "moves it into place.  append writes to the file "
+                        "itself, undoing a partial commit on startup.  "
+                        "Defaults to copy")
+    parser.add_argument('-hash', default='md5',
+                        choices=sorted(hash_algorithms),
+                        help="Algorithm for file hashes.  Must match on the "
+                        "primary and secondary.  Defaults to md5")
+    parser.add_argument('-hash-threads', default=4, type=int,
+                        help="Number of files hashed at once.  "
+                        "Defaults to 4")
+    parser.add_argument('-replication', default='sync',
+                        choices=['sync', 'async'],
+                        help="sync replicates a commit to the secondary "
+                        "before writing it.  async ACKs once the commit is "
+                        "durable here, and replicates it in the background.  "
+                        "Defaults to sync")
+    parser.add_argument('-max-lag-txns', default=100, type=int,
+                        help="With async replication, the most commits and "
+                        "aborts the secondary may be behind.  Defaults to 100")
+    parser.add_argument('-max-lag-bytes', default=64*1024*1024, type=int,
+                        help="With async replication, the most bytes the "
+                        "secondary may be behind.  Defaults to 64MB")
+    parser.add_argument('-snapshot-interval', default=300, type=float,
+                        help="Seconds between snapshots of the log, after "
+                        "which older log segments are removed.  0 to never "
+                        "snapshot.  Defaults to 300")
+    parser.add_argument('-txn-ttl', default=300, type=float,
+                        help="Seconds a transaction may stay open before it "
+                        "is aborted.  0 to never abort.  Defaults to 300")
+    parser.add_argument('-reap-batch', default=100, type=int,
+                        help="Most expired transactions aborted at a time.  "
+                        "Defaults to 100")
+    parser.add_argument('-sync-connections', default=4, type=int,
+                        help="Number of files a new secondary fetches from "
+                        "the primary at once.  Defaults to 4")
+    parser.add_argument('-secondary-reads', action='store_true',
+                        help="Let clients READ from the secondary, once it "
+                        "has synced with the primary")
+    parser.add_argument('-read-cache', default=0, type=int,
+                        help="Bytes of recently read files to keep in memory "
+                        "for READ.  Defaults to 0 (no cache)")
     parser.add_argument("-v", "--verbosity", action="count", help="Show debugging output.")
     args = parser.parse_args()
 
@@ -88,11 +270,77 @@ class Heartbeat(DatagramProtocol, TimeoutMixin):
         self.transport.write(self.msg, ("228.0.0.5", 8005))
 
 
+class RangeSender(FileSender):
+    """ A FileSender that stops after length bytes, or at the end of the file. """
+
+    def __init__(self, length=None):
+        self.remaining = length
+
+    def resumeProducing(self):
+        chunk = ''
+        if self.file and self.remaining != 0:
+            size = self.CHUNK_SIZE
+            if self.remaining is not None:
+                size = min(size, self.remaining)
+                self.remaining -= size
+            chunk = self.file.read(size)
+        if not chunk:
+            self.file = None
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(self.lastSent)
+                self.deferred = None
+            return
+
+        if self.transform:
+            chunk = self.transform(chunk)
+        self.consumer.write(chunk)
+        self.lastSent = chunk[-1:]
+
+
+class RecordSender():
+    """
+    A pull producer writing the strings from an iterator to a consumer, a
+    batch at a time, as the consumer asks for more.
+    """
+
+    batch = 256
+    deferred = None
+
+    def beginTransfer(self, records, consumer):
+        self.records = records
+        self.consumer = consumer
+        # With nothing to send, the transfer is done before registerProducer
+        # returns, and self.deferred is already cleared
+        self.deferred = deferred = defer.Deferred()
+        self.consumer.registerProducer(self, False)
+        return deferred
+
+    def resumeProducing(self):
+        chunk = "".join(itertools.islice(self.records, self.batch))
+        if not chunk:
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(None)
+                self.deferred = None
+            return
+        self.consumer.write(chunk)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        if self.deferred:
+            self.deferred.errback(
+                Exception("Consumer asked us to stop producing"))
+            self.deferred = None
+
+
 class SyncProtocol(LineReceiver):
     """
     Reads and parses a message to the secondary server.
 
-    Send: NEW_SEC, READ, SYNC_LOG, SEC_COMMIT, SEC_ABORT
+    Send: NEW_SEC
     Format:
     -> METHOD txn_id seq length
     ->
@@ -109,16 +357,13 @@ class SyncProtocol(LineReceiver):
     -> METHOD txn_id seq error_num length
     ->
     -> error_reason
-
-    Receive: file contents
-    Format:
-    -> file_contents    
     """
 
     firstLine = True
     method = None
     length = None
     buf = None
+    chunks = None  # Pieces of the body, joined once it is all read
     deferred = None
 
     def sendNEW_SEC(self, host, port, files):
@@ -128,39 +373,13 @@ class SyncProtocol(LineReceiver):
         self.deferred = defer.Deferred()
         return self.deferred
 
-    def sendREAD(self, fname):
-        msg = "READ 0 0 %d\r\n\r\n%s\r\n" % (len(fname), fname)
-        self.transport.write(msg)
-        self.buf = ""
-        self.setRawMode()
-        self.deferred = defer.Deferred()
-        return self.deferred
-
-    def sendSYNC_LOG(self):
-        msg = "SYNC_LOG 0 0 0\r\n\r\n\r\n"
-        self.transport.write(msg)
-        self.buf = ""
-        self.setRawMode()
-        self.deferred = defer.Deferred()
-        return self.deferred
-
-    def sendSEC_COMMIT(self, txn_id, seq, log):
-        msg = "SEC_COMMIT %d %d %d\r\n\r\n%s\r\n" % (txn_id, seq, len(log), log)
-        self.transport.write(msg)
-        self.deferred = defer.Deferred()
-        return self.deferred
-
-    def sendSEC_ABORT(self, txn_id, seq, log):
-        msg = "SEC_ABORT %d %d %d\r\n\r\n%s\r\n" % (txn_id, seq, len(log), log)
-        self.transport.write(msg)
-        self.deferred = defer.Deferred()
-        return self.deferred
-
     def lineReceived(self, line):
         if verbosity > 3:
             print 'SyncProtocol rcv:', line
         # Many assumptions about incoming data, since from server
         if self.firstLine:
+            if not line:
+                return  # End of the previous message
             self.firstLine = False
 
             l = line.split()
@@ -177,34 +396,344 @@ class SyncProtocol(LineReceiver):
             return
 
         if not line:
-            self.buf = ""
+            self.chunks = []
             self.setRawMode()
 
     def rawDataReceived(self, data):
         if self.length is None:
-            self.buf += data
-        if self.length is not None:
-            data = data[:self.length]
-            self.buf += data
-            self.length -= len(data)
+            self.chunks.append(data)  # Read until the connection closes
+            return
+        rest = data[self.length:]
+        data = data[:self.length]
+        self.chunks.append(data)
+        self.length -= len(data)
         if self.length == 0:
+            self.processMessage()
             self.transport.loseConnection()
+            self.setLineMode(rest)
 
     def connectionLost(self, reason):
         self.processMessage()
 
     def processMessage(self):
+        if self.chunks is not None:
+            self.buf = "".join(self.chunks)
+        self.firstLine = True
+        self.method = self.length = self.chunks = None
         if self.deferred is not None:
             d, self.deferred = self.deferred, None
             d.callback(self.buf)
 
+class FetchProtocol(LineReceiver):
+    """
+    Fetches a range of one file from the primary for a new secondary,
+    writing it into path as it arrives.  KEEP_ALIVE comes first, so the
+    reply is framed and an ERROR can't be taken for file contents.
+
+    Send: KEEP_ALIVE, READ
+    Format:
+    -> READ 0 0 length
+    ->
+    -> file_name
+    -> offset range_length
+
+    Receive: ACK, then READ or ERROR
+    Format:
+    -> READ txn_id seq 0 length
+    ->
+    -> file contents
+    """
+
+    def __init__(self, fname, path, offset, length):
+        self.fname = fname
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.received = 0
+        self.file = None
+        self.error = None  # ERROR header, then its reason
+        self.started = False  # Past the READ header?
+        self.deferred = defer.Deferred()
+
+    def connectionMade(self):
+        self.file = open(self.path, 'r+b')
+        self.file.seek(self.offset)
+        buf = "%s\r\n%d %d" % (self.fname, self.offset, self.length)
+        msg = "KEEP_ALIVE 0 0 0\r\n\r\n\r\nREAD 0 0 %d\r\n\r\n%s\r\n" % (
+            len(buf), buf)
+        self.transport.write(msg)
+
+    def lineReceived(self, line):
+        if verbosity > 3:
+            print 'FetchProtocol rcv:', line
+        if self.error is not None:
+            if line:
+                self.error += ": " + line
+                self.transport.loseConnection()
+            return
+        if line.startswith("ERROR"):
+            self.error = line
+        elif line.startswith("READ"):
+            self.length = min(self.length, int(line.split()[4]))
+            self.started = True
+        elif not line and self.started:
+            if self.length == 0:
+                self.transport.loseConnection()
+            else:
+                self.setRawMode()  # The file contents follow
+
+    def rawDataReceived(self, data):
+        data = data[:self.length - self.received]
+        self.file.write(data)
+        self.received += len(data)
+        if self.received == self.length:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.file is not None:
+            self.file.close()
+        d, self.deferred = self.deferred, None
+        if self.error is not None:
+            d.errback(Exception(208, "Primary could not send %s: %s" % (
+                self.fname, self.error)))
+        else:
+            d.callback(self.received)
+
+class CatchUpProtocol(Protocol):
+    """
+    Fetches the transactions the primary finished since a log position,
+    restoring each as it is parsed.
+
+    Send: SYNC_LOG
+    Format:
+    -> SYNC_LOG 0 0 length
+    ->
+    -> log_id segment offset (empty for the whole log)
+
+    Receive: the position reached, then the records, until the primary
+    closes the connection
+    Format:
+    -> SYNC_LOG log_id segment offset
+    -> txn_id status writes_committed start_time name_length file_name ...
+    """
+
+    def __init__(self, since, restore):
+        self.since = since
+        self.restore = restore
+        self.position = None
+        self.count = 0
+        self.failed = None
+        self.buf = bytearray()
+        self.deferred = defer.Deferred()
+
+    def connectionMade(self):
+        buf = ""
+        if self.since is not None:
+            buf = "%s %d %d" % tuple(self.since)
+        msg = "SYNC_LOG 0 0 %d\r\n\r\n%s\r\n" % (len(buf), buf)
+        self.transport.write(msg)
+
+    def dataReceived(self, data):
+        if self.failed is not None:
+            return
+        self.buf.extend(data)
+        if self.position is None:
+            end = self.buf.find("\r\n")
+            if end < 0:
+                return
+            line = str(self.buf[:end])
+            del self.buf[:end + 2]
+            l = line.split()
+            if len(l) != 4 or l[0] != "SYNC_LOG":
+                self.failed = Exception(208, "Failed on other server. Line: %s" % line)
+                self.transport.loseConnection()
+                return
+            self.position = (l[1], int(l[2]), int(l[3]))
+
+        # Parse the whole records received, keep the rest for later
+        record = TransactionLog.catchup_record
+        start = 0
+        while len(self.buf) - start >= record.size:
+            (txn_id, status, writes_committed, start_time,
+             name_length) = record.unpack_from(self.buf, start)
+            end = start + record.size + name_length
+            if len(self.buf) < end:
+                break
+            txn_info = {'file': str(self.buf[start + record.size:end]),
+                        'status': TransactionLog.statuses[status],
+                        'writes': {},
+                        'writes_committed': writes_committed,
+                        'start_time': start_time}
+            self.restore(txn_id, txn_info)
+            self.count += 1
+            start = end
+        del self.buf[:start]
+
+    def connectionLost(self, reason):
+        d, self.deferred = self.deferred, None
+        if self.failed is None and (self.position is None or self.buf):
+            self.failed = Exception(208, "Log from the primary was cut short.")
+        if self.failed is not None:
+            d.errback(self.failed)
+        else:
+            d.callback(self.position)
+
+class ReplicationProtocol(LineReceiver):
+    """
+    The primary's end of the replication channel to the secondary.
+
+    Opens the channel with SEC_OPEN, then sends SEC_NEW_TXN, SEC_WRITE,
+    SEC_COMMIT and SEC_ABORT requests tagged with a request id, without
+    waiting for earlier replies.
+    Format:
+    -> METHOD txn_id seq length req_id
+    ->
+    -> buf
+
+    Receive: ACK, ERROR, ASK_RESEND
+    Format:
+    -> METHOD txn_id req_id error_num length
+    ->
+    -> error_reason or missing writes
+    """
+
+    firstLine = True
+    method = None
+    req_id = None
+    error = None
+    length = None
+    chunks = None  # Pieces of the reply's body
+    next_id = 1
+    pending = None  # req_id -> Deferred waiting for the reply
+
+    def connectionMade(self):
+        self.pending = {}
+        self.transport.write("SEC_OPEN 0 0 0\r\n\r\n\r\n")
+        self.factory.channelOpened(self)
+
+    def sendRequest(self, method, txn_id, seq, buf):
+        req_id = self.next_id
+        self.next_id += 1
+        msg = "%s %d %d %d %d\r\n\r\n%s\r\n" % (
+            method, txn_id, seq, len(buf), req_id, buf)
+        self.transport.write(msg)
+        d = defer.Deferred()
+        self.pending[req_id] = d
+        return d
+
+    def lineReceived(self, line):
+        if verbosity > 3:
+            print 'ReplicationProtocol rcv:', line
+        if self.firstLine:
+            if not line:
+                return  # End of the previous reply
+            self.firstLine = False
+            (self.method, __, req_id, error, length) = line.split()
+            self.req_id = int(req_id)
+            self.error = int(error)
+            self.length = int(length)
+            self.chunks = []
+            return
+        if not line:
+            if self.length == 0:
+                self.replyReceived()
+            else:
+                self.setRawMode()
+
+    def rawDataReceived(self, data):
+        rest = data[self.length:]
+        data = data[:self.length]
+        self.chunks.append(data)
+        self.length -= len(data)
+        if self.length == 0:
+            self.replyReceived()
+            self.setLineMode(rest)
+
+    def replyReceived(self):
+        d = self.pending.pop(self.req_id, None)
+        (method, error, buf) = (self.method, self.error, "".join(self.chunks))
+        self.firstLine = True
+        self.method = self.req_id = self.error = self.length = self.chunks = None
+        if d is None:
+            return
+        if method == 'ACK':
+            d.callback( ('ACK', None) )
+        elif method == 'ASK_RESEND':
+            d.callback( ('ASK_RESEND', [int(k) for k in buf.split(',')]) )
+        else:
+            d.errback(Exception(208, "Failed on other server: %s" % buf))
+
+    def connectionLost(self, reason):
+        self.factory.channelClosed(self)
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(error.ConnectionLost("Replication channel closed."))
+
+
+class ReplicationFactory(ReconnectingClientFactory):
+    """
+    Keeps one replication channel open to the secondary, reconnecting with
+    exponential backoff.  Requests made while connecting are queued.
+    """
+
+    protocol = ReplicationProtocol
+    maxDelay = 10  # seconds between reconnection attempts, at most
+
+    channel = None  # Connected ReplicationProtocol
+    queued = None  # (method, txn_id, seq, buf, Deferred) waiting to connect
+
+    def __init__(self):
+        self.queued = []
+
+    def request(self, method, txn_id, seq, buf):
+        """ Send a request to the secondary.  Returns a Deferred of the reply. """
+        if self.channel is not None:
+            return self.channel.sendRequest(method, txn_id, seq, buf)
+        if not self.continueTrying:
+            return defer.fail(error.ConnectError("Replication stopped."))
+        d = defer.Deferred()
+        self.queued.append((method, txn_id, seq, buf, d))
+        return d
+
+    def channelOpened(self, channel):
+        if verbosity > 0:
+            print "PRI replication channel open"
+        self.resetDelay()
+        self.channel = channel
+        queued, self.queued = self.queued, []
+        for (method, txn_id, seq, buf, d) in queued:
+            channel.sendRequest(method, txn_id, seq, buf).chainDeferred(d)
+
+    def channelClosed(self, channel):
+        if verbosity > 0:
+            print "PRI replication channel closed"
+        self.channel = None
+
+    def clientConnectionFailed(self, connector, reason):
+        # Don't hold up commits while the secondary is unreachable
+        self.failQueued(reason)
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def failQueued(self, reason):
+        queued, self.queued = self.queued, []
+        for (method, txn_id, seq, buf, d) in queued:
+            d.errback(reason)
+
+    def stop(self):
+        self.stopTrying()
+        self.failQueued(failure.Failure(error.ConnectError("Replication stopped.")))
+        if self.channel is not None:
+            self.channel.transport.loseConnection()
+
+
 # Messages parsing modeled off of twisted.web.http HTTPClient and HTTPChannel
 class FilesystemProtocol(LineReceiver, TimeoutMixin):
     """
     Reads and parses a message to the primary server.
 
     Receive: NEW_TXN, WRITE, ABORT, COMMIT, READ, NEW_SEC, SYNC_LOG,
-             SEC_COMMIT, SEC_ABORT
+             SEC_OPEN, SEC_NEW_TXN, SEC_WRITE, SEC_COMMIT, SEC_ABORT, STATS,
+             KEEP_ALIVE
     Format:
     -> METHOD txn_id seq length
     ->
@@ -220,108 +749,211 @@ class FilesystemProtocol(LineReceiver, TimeoutMixin):
     Format:
     -> file_contents
 
-    Send: SYNC_FILES
+    Send: SYNC_FILES, STATS
     Format:
     -> METHOD length
     ->
-    -> file_list
+    -> file_list or stats
+
+    SEC_OPEN turns the connection into a replication channel from the
+    primary.  It stays open, and each request carries a request id:
+    -> METHOD txn_id seq length req_id
+    The replies carry the req_id in place of seq, and ASK_RESEND lists the
+    missing writes in its body.
+
+    KEEP_ALIVE keeps a client's connection open too, so it can pipeline
+    requests.  Replies carry the request's seq, and may come out of
+    order.  WRITE is answered with an ACK, ASK_RESEND lists the missing
+    writes in its body, and the file contents of a READ are framed:
+    -> READ txn_id seq 0 length
+    ->
+    -> file_contents
+    Other replies wait while a READ is being sent.
     """
     method = None
     txn = None
     seq = None
     length = None
+    req_id = None
     buf = None
+    chunks = None  # Pieces of the body, joined into buf once it is all read
     data = True  # Is there data for this message?
     firstLine = True
+    persistent = False  # Read more messages after this one?
+    channel = False  # Replication channel from the primary?
+    keep_alive = False  # Client connection kept open with KEEP_ALIVE?
+    keep_alive_timeout = 60  # seconds
+    replying = 0  # Kept open messages not yet answered, the timeout waits
+    done = False  # Message read, ignore anything after it
+    reading = False  # Sending a READ, other replies are queued
+    queued = None  # Replies, or READs to start, waiting for that READ
 
     def connectionMade(self):
         self.setTimeout(3)  # seconds
 
     def connectionLost(self, reason):
         self.setTimeout(None)
+        if self.channel:
+            self.factory.service.channelClosed(self)
 
     def lineReceived(self, line):
         if verbosity > 3:
             print 'FilesystemProtocol rcv:', line
+        if self.done:
+            return
         self.resetTimeout()
         if self.firstLine:
+            if not line and self.persistent:
+                return  # End of the previous message
             self.firstLine = False
             l = line.split()
+            if len(l) == 5 and self.channel:
+                self.req_id = l.pop()
             if len(l) != 4:
-                self.sendError(204, "Header has the wrong number of fields.")
+                self.headerError("Header has the wrong number of fields.")
                 return
             self.method, self.txn, self.seq, self.length = l
             try:
                 self.txn = int(self.txn)
                 self.seq = int(self.seq)
                 self.length = int(self.length)
+                if self.req_id is not None:
+                    self.req_id = int(self.req_id)
             except ValueError:
-                self.sendError(204, "Header has non-numeric value.")
+                self.headerError("Header has non-numeric value.")
                 return
 
             if self.seq < 0:
-                self.sendError(204,
-                               "Sequence number has to be a positive integer.")
+                self.headerError("Sequence number has to be a positive integer.")
                 return
             return
         # No expected data, so process the message
         if not self.data:
-            self.processMessage()
+            self.messageReceived()
+            return
         # Blank line - prepare to process data
         if not line:
             if self.length == 0:  # Probably COMMIT or ABORT
                 self.data = False
                 return
-            self.buf = ""
+            self.chunks = []
             self.setRawMode()  # Data arrives at rawDataReceived
 
     def rawDataReceived(self, data):
-        if self.length is not None:
-            data = data[:self.length]
-            self.buf += data
-            self.length -= len(data)
+        if self.done:
+            return
+        self.resetTimeout()
+        rest = data[self.length:]
+        data = data[:self.length]
+        self.chunks.append(data)
+        self.length -= len(data)
         if self.length == 0:
-            self.processMessage()
+            # Joined once, so a body costs its length whatever the chunking
+            self.buf = "".join(self.chunks)
+            self.chunks = None
+            self.messageReceived()
+            if self.persistent:
+                self.setLineMode(rest)  # Next message
+
+    def messageReceived(self):
+        """ Process the message just read, and get ready for the next one. """
+        if self.keep_alive:
+            self.req_id = self.seq  # Replies are matched by txn and seq
+            # Not idle while working on it, however long that takes
+            self.replying += 1
+            self.setTimeout(None)
+        self.processMessage()
+        if self.persistent:
+            self.method = self.txn = self.seq = self.length = None
+            self.req_id = self.buf = None
+            self.data = True
+            self.firstLine = True
+        else:
+            self.done = True
 
     def timeoutConnection(self):
         if verbosity > 0:
             print "Timing out client: %s" % str(self.transport.getPeer())
-        self.sendError(204,
-                       "Connection timed out (is length longer than data?)")
-
-    def sendError(self, err_num, err_reason):
-        if not isinstance(self.txn, int):
-            self.txn = -1
-        error = "ERROR %d 0 %d %d\r\n\r\n%s\r\n\r\n" % (
-                self.txn, err_num, len(err_reason), err_reason)
-        self.transport.write(error)
-        self.transport.loseConnection()
-
-    def sendACK(self):
-        ack = "ACK %d 0 0 0\r\n\r\n\r\n" % (self.txn)
-        self.transport.write(ack)
-        self.transport.loseConnection()
-
-    def sendASK_RESEND(self, missing_writes):
+        self.headerError("Connection timed out (is length longer than data?)")
+
+    def headerError(self, err_reason):
+        """ The message could not be read, so the connection is closed. """
+        self.persistent = False
+        self.done = True
+        self.sendError(204, err_reason)
+
+    def reply(self, msg):
+        """ Send msg, then close the connection unless it is kept open. """
+        if self.reading:
+            self.queued.append(msg)
+            return
+        if msg:
+            self.transport.write(msg)
+        if not self.persistent:
+            self.transport.loseConnection()
+        self.replied()
+
+    def replied(self):
+        """ A kept open message was answered.  Time out once all are. """
+        if self.keep_alive and self.replying > 0:
+            self.replying -= 1
+            if self.replying == 0:
+                self.setTimeout(self.keep_alive_timeout)
+
+    def sendError(self, err_num, err_reason, txn=None, req_id=None):
+        if txn is None:
+            txn = self.txn
+        if req_id is None:
+            req_id = self.req_id
+        if not isinstance(txn, int):
+            txn = -1
+        error = "ERROR %d %d %d %d\r\n\r\n%s\r\n\r\n" % (
+                txn, req_id or 0, err_num, len(err_reason), err_reason)
+        self.reply(error)
+
+    def sendACK(self, txn, req_id=None):
+        ack = "ACK %d %d 0 0\r\n\r\n\r\n" % (txn, req_id or 0)
+        self.reply(ack)
+
+    def sendASK_RESEND(self, missing_writes, txn, req_id=None):
+        if req_id is not None:
+            writes = ",".join([str(write) for write in missing_writes])
+            self.reply("ASK_RESEND %d %d 0 %d\r\n\r\n%s\r\n" % (
+                txn, req_id, len(writes), writes))
+            return
         resend_string = "ASK_RESEND %d %d 0 0\r\n\r\n\r\n"
         for write in missing_writes:
-            resend = resend_string % (self.txn, write)
+            resend = resend_string % (txn, write)
             self.transport.write(resend)
-        self.transport.loseConnection()
+        self.reply(None)
 
-    def sendSYNC_FILES(self, files):
-        msg = "SYNC_FILES %d\r\n\r\n%s\r\n" % (len(files), files)
-        self.transport.write(msg)
-        self.transport.loseConnection()
+    def sendSYNC_FILES(self, files, txn, req_id):
+        if self.keep_alive:
+            msg = "SYNC_FILES %d %d 0 %d\r\n\r\n%s\r\n" % (
+                txn, req_id, len(files), files)
+        else:
+            msg = "SYNC_FILES %d\r\n\r\n%s\r\n" % (len(files), files)
+        self.reply(msg)
+
+    def sendSTATS(self, stats):
+        if self.keep_alive:
+            msg = "STATS %d %d 0 %d\r\n\r\n%s\r\n" % (
+                self.txn, self.req_id, len(stats), stats)
+        else:
+            msg = "STATS %d\r\n\r\n%s\r\n" % (len(stats), stats)
+        self.reply(msg)
 
     def processMessage(self):
-        self.setTimeout(None)
+        if not self.persistent:
+            self.setTimeout(None)
         if self.method == "READ":
             self.processREAD()
         elif self.method == "NEW_TXN":
             self.processNEW_TXN()
         elif self.method == "WRITE":
             self.processWRITE()
+        elif self.method == "WRITE_BATCH":
+            self.processWRITE_BATCH()
         elif self.method == "COMMIT":
             self.processCOMMIT()
         elif self.method == "ABORT":
@@ -330,95 +962,1082 @@ class FilesystemProtocol(LineReceiver, TimeoutMixin):
             self.processNEW_SEC()
         elif self.method == "SYNC_LOG":
             self.processSYNC_LOG()
+        elif self.method == "SEC_OPEN":
+            self.processSEC_OPEN()
+        elif self.method == "SEC_NEW_TXN":
+            self.processSEC_NEW_TXN()
+        elif self.method == "SEC_WRITE":
+            self.processSEC_WRITE()
         elif self.method == "SEC_COMMIT":
             self.processSEC_COMMIT()
         elif self.method == "SEC_ABORT":
             self.processSEC_ABORT()
+        elif self.method == "STATS":
+            self.processSTATS()
+        elif self.method == "KEEP_ALIVE":
+            self.processKEEP_ALIVE()
         else:
-            self.sendError(204, "Method does not exist.")
+            self.sendError(204, "Method does not exist.", req_id=self.req_id)
 
     def processREAD(self):
-        (error, buf) = self.factory.service.readFile(self.buf)
+        # An optional second line asks for a range: offset length, or
+        # just offset for everything after it, to tail a growing file
+        lines = self.buf.split('\r\n', 1)
+        (offset, length) = (0, None)
+        if len(lines) == 2:
+            try:
+                fields = map(int, lines[1].split())
+            except ValueError:
+                fields = []
+            if len(fields) not in (1, 2):
+                self.sendError(204, "Range must be an offset and an optional length.")
+                return
+            offset = fields[0]
+            if len(fields) == 2:
+                length = fields[1]
+            if offset < 0 or (length is not None and length < 0):
+                self.sendError(204, "Range must not be negative.")
+                return
+        (error, f) = self.factory.service.readFile(lines[0], self.txn)
         if error != 0:
-            self.sendError(error, buf)
+            self.sendError(error, f)
+            return
+        if not self.keep_alive:
+            self.sendFile(f, offset, length, None)
+            return
+        # The length goes in the header, so later growth isn't sent
+        f.seek(0, os.SEEK_END)
+        size = max(0, f.tell() - offset)
+        if length is None or length > size:
+            length = size
+        header = "READ %d %d 0 %d\r\n\r\n" % (self.txn, self.seq, length)
+        if self.reading:
+            self.queued.append(lambda: self.sendFile(f, offset, length, header))
         else:
-            self.transport.write(buf)
+            self.sendFile(f, offset, length, header)
+
+    def sendFile(self, f, offset, length, header):
+        """ Stream length bytes of f from offset, after header if framed. """
+        f.seek(offset)
+        if header is not None:
+            self.transport.write(header)
+            self.reading = True
+            self.queued = []
+        # Stream the file in chunks, FileSender pauses when the client is slow
+        sender = RangeSender(length)
+        d = sender.beginFileTransfer(f, self.transport)
+        d.addBoth(self.finishREAD, f)
+
+    def finishREAD(self, result, f):
+        f.close()
+        if not self.reading:
             self.transport.loseConnection()
+            return
+        self.transport.write("\r\n")
+        self.replied()
+        # Send what waited for the READ, up to the next READ
+        self.reading = False
+        queued, self.queued = self.queued, []
+        while queued:
+            item = queued.pop(0)
+            if callable(item):
+                item()
+            else:
+                self.reply(item)
+            if self.reading:
+                self.queued = queued + self.queued
+                break
 
     def processNEW_TXN(self):
-        (txn_id, error, error_reason) = self.factory.service.startNewTxn(self.buf)
-        if error != 0:
-            self.sendError(error, error_reason)
-        else:
-            self.txn = txn_id
-            self.sendACK()
+        d = self.factory.service.startNewTxn(self.buf)
+        d.addCallbacks(self.newTxnSuccess, self.commitFail,
+                       callbackArgs=(self.req_id,),
+                       errbackArgs=(self.txn, self.req_id))
 
     def processWRITE(self):
-        (error, error_reason) = self.factory.service.saveWrite(self.txn, self.seq, self.buf)
-        if error != 0:
-            self.sendError(error, error_reason)
-        self.transport.loseConnection()
+        d = self.factory.service.saveWrite(self.txn, self.seq, self.buf)
+        d.addCallbacks(self.writeSuccess, self.commitFail,
+                       callbackArgs=(self.txn, self.req_id),
+                       errbackArgs=(self.txn, self.req_id))
+
+    def processWRITE_BATCH(self):
+        # One reply, so ASK_RESEND lists the gaps together in its body
+        if self.req_id is None:
+            self.req_id = self.seq
+        d = defer.maybeDeferred(splitBatch, self.buf or "")
+        d.addCallback(lambda writes: self.factory.service.saveWrites(
+                self.txn, self.seq, writes))
+        self.addReplies(d)
 
     def processABORT(self):
         d = self.factory.service.abortTxn(self.txn, self.seq)
-        d.addCallbacks(self.commitSuccess, self.commitFail)
+        self.addReplies(d)
 
     def processCOMMIT(self):
         d = self.factory.service.commitTxn(self.txn, self.seq)
-        d.addCallbacks(self.commitSuccess, self.commitFail)
+        self.addReplies(d)
 
     def processNEW_SEC(self):
         (peer, files) = self.buf.split('\r\n', 1)
         (host, port) = peer.split()
         if verbosity > 2:
             print "Files from secondary:", files
-        diff_files = self.factory.service.addSecondary(host, int(port), files)
-        self.sendSYNC_FILES(diff_files)
+        d = self.factory.service.addSecondary(host, int(port), files)
+        d.addCallbacks(self.sendSYNC_FILES, self.commitFail,
+                       callbackArgs=(self.txn, self.req_id),
+                       errbackArgs=(self.txn, self.req_id))
 
     def processSYNC_LOG(self):
-        log = self.factory.service.syncLog()
-        self.transport.write(log)
-        self.transport.loseConnection()
+        # The records run until the connection closes, so it can't be shared
+        if self.keep_alive:
+            self.sendError(204, "SYNC_LOG needs a connection of its own.")
+            return
+        since = None
+        if self.buf:
+            try:
+                (log_id, segment, offset) = self.buf.split()
+                since = (log_id, int(segment), int(offset))
+            except ValueError:
+                self.sendError(204, "Position must be a log id, segment and offset.")
+                return
+        (position, records) = self.factory.service.syncLog(since)
+        self.transport.write("SYNC_LOG %s %d %d\r\n" % position)
+        sender = RecordSender()
+        d = sender.beginTransfer(records, self.transport)
+        d.addBoth(lambda _: self.transport.loseConnection())
+
+    def processSEC_OPEN(self):
+        if verbosity > 0:
+            print "Replication channel opened by", self.transport.getPeer()
+        self.setTimeout(None)
+        self.persistent = True
+        self.channel = True
+        self.factory.service.channelOpened(self)
+
+    def processSEC_NEW_TXN(self):
+        d = defer.maybeDeferred(self.factory.service.streamNewTxn,
+                                self.txn, self.buf)
+        self.addReplies(d)
+
+    def processSEC_WRITE(self):
+        d = defer.maybeDeferred(self.factory.service.streamWrite,
+                                self.txn, self.seq, self.buf)
+        self.addReplies(d)
 
     def processSEC_COMMIT(self):
         d = self.factory.service.writeLog('COMMIT', self.txn, self.seq, self.buf)
-        d.addCallbacks(self.commitSuccess, self.commitFail)
+        self.addReplies(d)
 
     def processSEC_ABORT(self):
         d = self.factory.service.writeLog('ABORT', self.txn, self.seq, self.buf)
-        d.addCallbacks(self.commitSuccess, self.commitFail)
+        self.addReplies(d)
+
+    def processSTATS(self):
+        self.sendSTATS(json.dumps(self.factory.service.stats()))
+
+    def processKEEP_ALIVE(self):
+        self.persistent = True
+        self.keep_alive = True
+        if not self.replying:  # Otherwise set once they are answered
+            self.setTimeout(self.keep_alive_timeout)
+        self.sendACK(self.txn, self.seq)
+
+    def addReplies(self, d):
+        """ Reply to this message with the outcome of d. """
+        d.addCallbacks(self.commitSuccess, self.commitFail,
+                       callbackArgs=(self.txn, self.req_id),
+                       errbackArgs=(self.txn, self.req_id))
+
+    def newTxnSuccess(self, txn_id, req_id):
+        self.sendACK(txn_id, req_id)
+
+    def writeSuccess(self, result, txn, req_id):
+        if self.keep_alive:
+            self.sendACK(txn, req_id)
+        else:
+            self.reply(None)
 
-    def commitSuccess(self, (action, writes)):
+    def commitSuccess(self, (action, writes), txn, req_id):
         if action == 'ASK_RESEND':
-            self.sendASK_RESEND(writes)
+            self.sendASK_RESEND(writes, txn, req_id)
         elif action == 'ACK':
-            self.sendACK()
+            self.sendACK(txn, req_id)
         else:
             print 'WTF ERROR', action, writes
 
-    def commitFail(self, reason):
+    def commitFail(self, reason, txn, req_id):
         try:
             (error, error_reason) = reason.value
-            self.sendError(error, error_reason)
+            self.sendError(error, error_reason, txn, req_id)
         except Exception, e:
             print "WTF ERROR", e
-            self.sendError(209, "An unknown error occurred.")
+            self.sendError(209, "An unknown error occurred.", txn, req_id)
+
+
+class TransactionLog():
+    """
+    Append-only write-ahead log of transactions, split into segment files.
+
+    Record format:
+    -> crc32 length type
+    -> payload
+
+    Record types and payloads:
+    -> NEW_TXN: txn_id start_time file_name
+    -> WRITE: txn_id seq offset length
+    -> WRITES: txn_id count, then seq offset length of each write in a batch
+    -> COMMIT: txn_id seq
+    -> ABORT: txn_id
+    -> FORGET: txn_id
+    -> PRECOMMIT: txn_id length of the file before appending
+    -> ROLLBACK: txn_id
+    -> POSITION: segment offset, where the next COMMIT or ABORT was logged
+
+    The transactions are kept in memory and rebuilt by replaying the
+    segments on startup.  Each operation appends one small record.
+
+    A position in the log is (segment, offset), and log_id tells logs with
+    the same positions apart.  finished keeps where each COMMIT and ABORT
+    record ends, so a secondary can fetch only what finished after the
+    position it has.  opened keeps the open transactions by start time, so
+    finding old ones doesn't scan every transaction.
+
+    Finished transactions keep only what COMMIT replies and catching up
+    need: file, status, writes_committed, start_time.  snapshot() writes
+    the whole state as records to .server_log/wal-snapshot-<N>, which
+    stands in for the segments before N, and removes those segments.  The
+    finished transactions come first, so the next snapshot copies them and
+    only adds those finished since.
+
+    The data of each WRITE goes to a per-transaction staging file,
+    .server_log/stage-<txn_id>, and the log only records where it is.
+    Staging files are removed once the transaction is committed or aborted.
+
+    With group commit, records appended within group_window seconds (or
+    until group_size records) share one fsync.
+    """
+
+    segment_prefix = "wal-"
+    snapshot_prefix = "wal-snapshot-"
+    staging_prefix = "stage-"
+    chunk_size = 64*1024  # For reading back staged writes
+    segment_size = 16*1024*1024  # Start a new segment after 16MB
+
+    (NEW_TXN, WRITE, COMMIT, ABORT, FORGET, PRECOMMIT, ROLLBACK,
+     POSITION, WRITES) = range(1, 10)
+
+    header = struct.Struct("!IIB")  # crc32, payload length, record type
+    new_txn_record = struct.Struct("!qd")  # txn_id, start_time
+    write_record = struct.Struct("!qqqq")  # txn_id, seq, offset, length
+    writes_record = struct.Struct("!qI")  # txn_id, count
+    batch_entry = struct.Struct("!qqq")  # seq, offset, length
+    commit_record = struct.Struct("!qq")  # txn_id, seq
+    precommit_record = struct.Struct("!qq")  # txn_id, file length
+    id_record = struct.Struct("!q")  # txn_id
+    position_record = struct.Struct("!qq")  # segment, offset
+    # Sent to a secondary catching up: txn_id, status (COMMIT or ABORT),
+    # writes_committed, start_time, file name length, then the file name
+    catchup_record = struct.Struct("!qBqdH")
+    # SEC_COMMIT from the primary: flags, number of writes, start_time,
+    # file name length
+    commit_frame = struct.Struct("!BqdH")
+    STREAMED = 1  # Flag: the writes were sent ahead, the frame has no data
+    statuses = {COMMIT: 'COMMIT', ABORT: 'ABORT'}
+
+    log_id_file = "wal-id"  # Removed with the segments on a reset
+
+    txns = None  # txn_id -> txn_info
+    next_id = 1
+    log_id = None
+    finished = None  # (segment, offset, txn_id) of each COMMIT and ABORT
+    opened = None  # (start_time, txn_id) of each open transaction, sorted
+    segment = None  # Number of the segment being appended to
+    offset = 0  # End of that segment
+    snapshot_segment = 0  # The latest snapshot replaces segments before it
+    snapshot_finished = 0  # Entries of finished in the latest snapshot
+    snapshot_bytes = 0  # Length of their records, at the snapshot's start
+    snapshotting = False
+    f = None
+
+    group_window = 0  # seconds, 0 to fsync on every sync()
+    group_size = 64
+    staging = None  # txn_id -> open staging file
+    dirty = None  # txn_ids with staged data not yet fsynced
+    unsynced = 0  # Records appended since the last fsync
+    waiting = None  # Deferreds fired at the next fsync
+    timer = None
+
+    def __init__(self, logdir, group_window=0, group_size=64):
+        self.logdir = logdir
+        self.group_window = group_window
+        self.group_size = group_size
+        self.txns = {}
+        self.finished = []
+        self.opened = []
+        self.waiting = []
+        self.staging = {}
+        self.dirty = set()
+        # Remove a snapshot left half written by a crash
+        pattern = "^" + self.snapshot_prefix + "[0-9]+\\.tmp$"
+        for f in os.listdir(self.logdir):
+            if re.search(pattern, f):
+                os.remove(os.path.join(self.logdir, f))
+        snapshots = self.segments(self.snapshot_prefix)
+        segments = self.segments()
+        self.loadLogId(not segments and not snapshots)
+        if snapshots:
+            self.snapshot_segment = snapshots[-1]
+            self.replaySnapshot(snapshots[-1])
+        segments = [n for n in segments if n >= self.snapshot_segment]
+        for n in segments:
+            self.replay(n, n == segments[-1])
+        if segments:
+            self.openSegment(segments[-1])
+        else:
+            self.openSegment(max(1, self.snapshot_segment))
+        self.removeCompacted()
+
+        # Remove staging files left by finished transactions
+        pattern = "^" + self.staging_prefix + "([0-9]+)$"
+        for f in os.listdir(self.logdir):
+            m = re.search(pattern, f)
+            if m and (self.txns.get(int(m.group(1)), {}).get('status')
+                      != 'NEW_TXN'):
+                os.remove(os.path.join(self.logdir, f))
+
+    def loadLogId(self, new):
+        """ Read the log's id, or make one up for a new log. """
+        path = os.path.join(self.logdir, self.log_id_file)
+        if not new and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.log_id = f.read().strip()
+        if not self.log_id:
+            self.log_id = binascii.hexlify(os.urandom(8))
+            with open(path, 'wb') as f:
+                f.write(self.log_id)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def segments(self, prefix=None):
+        """ Returns the numbers of the segments on disk, oldest first. """
+        pattern = "^" + (prefix or self.segment_prefix) + "([0-9]+)$"
+        found = [re.search(pattern, f) for f in os.listdir(self.logdir)]
+        return sorted([int(m.group(1)) for m in found if m])
+
+    def segmentPath(self, n):
+        return os.path.join(self.logdir, "%s%08d" % (self.segment_prefix, n))
+
+    def snapshotPath(self, n):
+        return os.path.join(self.logdir, "%s%08d" % (self.snapshot_prefix, n))
+
+    def stagingPath(self, txn_id):
+        return os.path.join(self.logdir, "%s%d" % (self.staging_prefix, txn_id))
+
+    def openSegment(self, n):
+        if self.f is not None:
+            self.f.close()
+        self.segment = n
+        self.f = open(self.segmentPath(n), 'ab')
+        self.offset = os.path.getsize(self.segmentPath(n))
+
+    def readRecords(self, path, torn_ok=False):
+        """
+        Yields the (type, payload, end offset) of each record in path.  If
+        torn_ok, a record torn by a crash ends the file.  Any other damage
+        raises IOError, as the records after it can't be trusted.
+        """
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                h = f.read(self.header.size)
+                if not h:
+                    break
+                payload = None
+                if len(h) == self.header.size:
+                    (crc, length, rtype) = self.header.unpack(h)
+                    payload = f.read(length)
+                    if (len(payload) != length or
+                        crc != self.checksum(rtype, payload)):
+                        payload = None
+                if payload is None:
+                    f.seek(offset)
+                    if not (torn_ok and self.isTorn(f.read())):
+                        raise IOError("Log %s is damaged at offset %d." % (
+                            path, offset))
+                    print "Log segment %s is torn at offset %d." % (path, offset)
+                    break
+                offset = f.tell()
+                yield (rtype, payload, offset)
+
+    def isTorn(self, tail):
+        """
+        True if tail, from a damaged record to the end of the file, is what
+        a crash while appending leaves: the record cut short or zeroed.
+        """
+        if len(tail) < self.header.size or not tail.strip("\0"):
+            return True
+        (__, length, __) = self.header.unpack_from(tail)
+        return self.header.size + length >= len(tail)
+
+    def replay(self, n, last):
+        """
+        Apply the records in segment n.  Only the last segment may end in a
+        torn record.
+        """
+        path = self.segmentPath(n)
+        offset = 0
+        for (rtype, payload, offset) in self.readRecords(path, torn_ok=last):
+            self.apply(rtype, payload, (n, offset))
+        # Drop the damaged tail, so new records are not appended after it
+        if last and offset != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+    def replaySnapshot(self, n):
+        """ Apply the records in snapshot n. """
+        position = None
+        for (rtype, payload, end) in self.readRecords(self.snapshotPath(n)):
+            if rtype == self.POSITION:
+                position = self.position_record.unpack(payload)
+            else:
+                self.apply(rtype, payload, position)
+            # The finished transactions come first, the next snapshot copies them
+            if rtype in (self.COMMIT, self.ABORT):
+                self.snapshot_bytes = end
+        self.snapshot_finished = len(self.finished)
+
+    def checksum(self, rtype, payload):
+        return zlib.crc32(payload, zlib.crc32(chr(rtype))) & 0xffffffff
+
+    def apply(self, rtype, payload, position):
+        """ Update the in memory transactions from one record, ending at position. """
+        if rtype == self.NEW_TXN:
+            (txn_id, start_time) = self.new_txn_record.unpack_from(payload)
+            self.unindex(txn_id)
+            bisect.insort(self.opened, (start_time, txn_id))
+            self.txns[txn_id] = {'file': payload[self.new_txn_record.size:],
+                                 'status': 'NEW_TXN',
+                                 'writes': {},
+                                 'writes_committed': -1,
+                                 'start_time': start_time}
+            self.next_id = max(self.next_id, txn_id + 1)
+        elif rtype == self.WRITE:
+            (txn_id, seq, offset, length) = self.write_record.unpack(payload)
+            self.txns[txn_id]['writes'][seq] = (offset, length)
+        elif rtype == self.WRITES:
+            (txn_id, count) = self.writes_record.unpack_from(payload)
+            writes = self.txns[txn_id]['writes']
+            for i in range(count):
+                (seq, offset, length) = self.batch_entry.unpack_from(
+                    payload, self.writes_record.size + i * self.batch_entry.size)
+                writes[seq] = (offset, length)
+        elif rtype == self.COMMIT:
+            (txn_id, seq) = self.commit_record.unpack(payload)
+            self.unindex(txn_id)
+            self.txns[txn_id]['status'] = 'COMMIT'
+            self.txns[txn_id]['writes_committed'] = seq
+            self.txns[txn_id]['writes'] = {}
+            self.txns[txn_id].pop('pre_length', None)
+            self.finished.append(position + (txn_id,))
+        elif rtype == self.ABORT:
+            (txn_id,) = self.id_record.unpack(payload)
+            self.unindex(txn_id)
+            self.txns[txn_id]['status'] = 'ABORT'
+            self.txns[txn_id]['writes'] = {}
+            self.finished.append(position + (txn_id,))
+        elif rtype == self.FORGET:
+            (txn_id,) = self.id_record.unpack(payload)
+            self.unindex(txn_id)
+            self.txns.pop(txn_id, None)
+        elif rtype == self.PRECOMMIT:
+            (txn_id, length) = self.precommit_record.unpack(payload)
+            self.txns[txn_id]['pre_length'] = length
+        elif rtype == self.ROLLBACK:
+            (txn_id,) = self.id_record.unpack(payload)
+            self.txns[txn_id].pop('pre_length', None)
+
+    def unindex(self, txn_id):
+        """ Remove txn_id from opened, if it is open. """
+        txn = self.txns.get(txn_id)
+        if txn is None or txn['status'] != 'NEW_TXN':
+            return
+        entry = (txn['start_time'], txn_id)
+        i = bisect.bisect_left(self.opened, entry)
+        if i < len(self.opened) and self.opened[i] == entry:
+            del self.opened[i]
+
+    def openTxns(self, started_before=None, limit=None):
+        """
+        Returns the ids of open transactions, oldest first.  Only those
+        started before started_before, and at most limit of them, if given.
+        """
+        end = len(self.opened)
+        if started_before is not None:
+            end = bisect.bisect_left(self.opened, (started_before,))
+        if limit is not None:
+            end = min(end, limit)
+        return [txn_id for (__, txn_id) in self.opened[:end]]
+
+    def pack(self, rtype, payload):
+        return self.header.pack(self.checksum(rtype, payload), len(payload),
+                                rtype) + payload
+
+    def append(self, rtype, payload):
+        """ Append a record to the log and apply it. Call sync to flush. """
+        record = self.pack(rtype, payload)
+        self.f.write(record)
+        self.offset += len(record)
+        self.apply(rtype, payload, (self.segment, self.offset))
+        self.unsynced += 1
+        if self.f.tell() >= self.segment_size:
+            self.flush()
+            self.openSegment(self.segment + 1)
+
+    def sync(self):
+        """
+        Make the records appended so far durable.  Returns a Deferred that
+        fires once they are on disk.
+        """
+        if self.group_window <= 0:
+            self.flush()
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.unsynced >= self.group_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = reactor.callLater(self.group_window, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Fsync the log now, and fire everything waiting on it.  If the fsync
+        fails, the waiting Deferreds errback, or it raises if none wait.
+        """
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        waiting, self.waiting = self.waiting, []
+        try:
+            # Staged data first, so the log never points past it
+            for txn_id in list(self.dirty):
+                if txn_id in self.staging:
+                    self.staging[txn_id].flush()
+                    os.fsync(self.staging[txn_id].fileno())
+                self.dirty.discard(txn_id)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        except (IOError, OSError) as e:
+            print "Log fsync failed: %s" % e
+            if not waiting:
+                raise
+            for d in waiting:
+                d.errback(Exception(205, "Could not sync the log."))
+            return
+        if verbosity > 3 and waiting:
+            print "Log fsync for %d records, %d waiting" % (
+                self.unsynced, len(waiting))
+        self.unsynced = 0
+        for d in waiting:
+            d.callback(None)
+
+    def snapshot(self):
+        """
+        Write the state of the log to a snapshot, in a thread, then remove
+        the segments it replaces.  Returns a Deferred fired when done.
+        """
+        if self.snapshotting or (self.segment == self.snapshot_segment and
+                                 self.offset == 0):
+            return defer.succeed(None)  # Nothing logged since the last one
+        self.snapshotting = True
+        # New records go to a new segment, the snapshot covers the rest
+        if self.offset > 0:
+            self.flush()
+            self.openSegment(self.segment + 1)
+        n = self.segment
+        (done, opened) = self.snapshotRecords()
+        previous = None
+        if self.snapshot_bytes > 0:
+            previous = (self.snapshotPath(self.snapshot_segment),
+                        self.snapshot_bytes)
+        d = threads.deferToThread(self.writeSnapshot, n, previous,
+                                  done + opened)
+        d.addCallback(self.snapshotWritten, n, len(self.finished),
+                      self.snapshot_bytes + sum(map(len, done)))
+        d.addBoth(self.snapshotDone)
+        return d
+
+    def snapshotRecords(self):
+        """
+        Returns the records of the transactions finished since the latest
+        snapshot, with the last COMMIT or ABORT of each kept in log order,
+        and the records of the open transactions.  The rest is copied from
+        the latest snapshot, so the work here grows only with what happened
+        since.
+        """
+        records = []
+        start = self.snapshot_finished
+        last = dict([(entry[2], i)
+                     for (i, entry) in enumerate(self.finished[start:])])
+        finished = []
+        for (i, (segment, offset, txn_id)) in enumerate(self.finished[start:]):
+            txn = self.txns.get(txn_id)
+            if last[txn_id] != i or txn is None or txn['status'] == 'NEW_TXN':
+                continue
+            finished.append((segment, offset, txn_id))
+            records.append(self.pack(self.POSITION,
+                self.position_record.pack(segment, offset)))
+            records.append(self.pack(self.NEW_TXN,
+                self.new_txn_record.pack(txn_id, txn['start_time']) +
+                txn['file']))
+            if txn['status'] == 'COMMIT':
+                records.append(self.pack(self.COMMIT,
+                    self.commit_record.pack(txn_id, txn['writes_committed'])))
+            else:
+                records.append(self.pack(self.ABORT,
+                    self.id_record.pack(txn_id)))
+        self.finished[start:] = finished
+
+        done, records = records, []
+        for txn_id in self.openTxns():
+            txn = self.txns[txn_id]
+            records.append(self.pack(self.NEW_TXN,
+                self.new_txn_record.pack(txn_id, txn['start_time']) +
+                txn['file']))
+            for seq in sorted(txn['writes']):
+                (offset, length) = txn['writes'][seq]
+                records.append(self.pack(self.WRITE,
+                    self.write_record.pack(txn_id, seq, offset, length)))
+            if 'pre_length' in txn:
+                records.append(self.pack(self.PRECOMMIT,
+                    self.precommit_record.pack(txn_id, txn['pre_length'])))
+        return (done, records)
+
+    def writeSnapshot(self, n, previous, records):
+        """
+        Runs in a thread.  Copies the first length bytes of the previous
+        snapshot, given as (path, length), then appends records.  The
+        snapshot only appears once it is on disk.
+        """
+        path = self.snapshotPath(n)
+        with open(path + ".tmp", 'wb') as f:
+            if previous is not None:
+                (previous_path, length) = previous
+                for chunk in readExtents(previous_path, [(0, length)],
+                                         self.chunk_size):
+                    f.write(chunk)
+            for record in records:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    def snapshotWritten(self, result, n, finished, size):
+        self.snapshot_segment = n
+        self.snapshot_finished = finished
+        self.snapshot_bytes = size
+        self.removeCompacted()
+        if verbosity > 1:
+            print "Log snapshot %d written, %d transactions" % (
+                n, len(self.txns))
+
+    def snapshotDone(self, result):
+        self.snapshotting = False
+        return result
+
+    def removeCompacted(self):
+        """ Remove the segments and snapshots older than the latest snapshot. """
+        for n in self.segments():
+            if n < self.snapshot_segment:
+                os.remove(self.segmentPath(n))
+        for n in self.segments(self.snapshot_prefix):
+            if n < self.snapshot_segment:
+                os.remove(self.snapshotPath(n))
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+        for f in self.staging.values():
+            f.close()
+        self.staging.clear()
+
+    def newTxn(self, file_name, start_time=None, txn_id=None):
+        """ Log a new transaction on file_name.  Returns the txn_id. """
+        if txn_id is None:
+            txn_id = self.next_id  # Past every id logged so far
+        if start_time is None:
+            start_time = time.time()
+        self.append(self.NEW_TXN,
+                    self.new_txn_record.pack(txn_id, start_time) + file_name)
+        return txn_id
+
+    def newTxnPayload(self, txn_id):
+        """ Returns the NEW_TXN record payload of txn_id, to send on. """
+        txn = self.txns[txn_id]
+        return self.new_txn_record.pack(txn_id, txn['start_time']) + txn['file']
+
+    def unpackNewTxn(self, payload):
+        """ Returns the file name and start time in a NEW_TXN payload. """
+        (txn_id, start_time) = self.new_txn_record.unpack_from(payload)
+        return (payload[self.new_txn_record.size:], start_time)
+
+    def stage(self, txn_id, buf):
+        """ Append buf to txn_id's staging file.  Returns its offset there. """
+        if txn_id not in self.staging:
+            self.staging[txn_id] = open(self.stagingPath(txn_id), 'ab')
+        f = self.staging[txn_id]
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(buf)
+        self.dirty.add(txn_id)
+        return offset
+
+    def addWrite(self, txn_id, seq, buf):
+        """ Stage buf and log where it was put. """
+        offset = self.stage(txn_id, buf)
+        self.append(self.WRITE,
+                    self.write_record.pack(txn_id, seq, offset, len(buf)))
+
+    def addWrites(self, txn_id, writes):
+        """
+        Stage the (seq, buf) writes of a batch, and log them in one record,
+        so replay finds all of them or none.
+        """
+        entries = [self.batch_entry.pack(seq, self.stage(txn_id, buf), len(buf))
+                   for (seq, buf) in writes]
+        self.append(self.WRITES,
+                    self.writes_record.pack(txn_id, len(entries)) +
+                    "".join(entries))
+
+    def extents(self, txn_id, seqs):
+        """
+        Returns where the writes seqs are in the staging file, as a list of
+        (offset, length).  The staged data is flushed so other threads and
+        file handles can read it.
+        """
+        if txn_id in self.staging:
+            self.staging[txn_id].flush()
+        writes = self.txns[txn_id]['writes']
+        return [writes[k] for k in seqs]
+
+    def readWrites(self, txn_id, seqs):
+        """ Yields the staged data of the writes seqs, a chunk at a time. """
+        if not seqs:
+            return iter([])
+        return readExtents(self.stagingPath(txn_id),
+                           self.extents(txn_id, seqs), self.chunk_size)
+
+    def discard(self, txn_id):
+        """ Remove the staged data of a finished transaction. """
+        f = self.staging.pop(txn_id, None)
+        if f is not None:
+            f.close()
+        self.dirty.discard(txn_id)
+        try:
+            os.remove(self.stagingPath(txn_id))
+        except OSError:
+            pass
+
+    def commit(self, txn_id, seq):
+        self.append(self.COMMIT, self.commit_record.pack(txn_id, seq))
+
+    def abort(self, txn_id):
+        self.append(self.ABORT, self.id_record.pack(txn_id))
+
+    def precommit(self, txn_id, length):
+        """
+        Log the length of a file before a commit appends to it in place,
+        -1 if it does not exist yet.
+        """
+        self.append(self.PRECOMMIT, self.precommit_record.pack(txn_id, length))
+
+    def rollback(self, txn_id):
+        """ Log that a partial append in place was undone. """
+        self.append(self.ROLLBACK, self.id_record.pack(txn_id))
+
+    def forget(self, txn_id):
+        self.append(self.FORGET, self.id_record.pack(txn_id))
+        self.discard(txn_id)
+
+    def exportCommit(self, txn_id, seq, extents=None):
+        """
+        Returns the SEC_COMMIT frame of a transaction committing writes 0
+        to seq-1, for the secondary: commit_frame, the file name, the
+        length of each write, then their data.  extents are where the
+        writes are staged, if already looked up.
+        """
+        txn = self.txns[txn_id]
+        if extents is None:
+            extents = self.extents(txn_id, range(seq))
+        lengths = [length for (offset, length) in extents]
+        return (self.commit_frame.pack(0, seq, txn['start_time'],
+                                       len(txn['file'])) +
+                txn['file'] + struct.pack("!%dI" % seq, *lengths) +
+                "".join(readExtents(self.stagingPath(txn_id), extents,
+                                    self.chunk_size)))
+
+    def commitMarker(self, txn_id, seq):
+        """ Returns a SEC_COMMIT frame for writes the secondary already has. """
+        txn = self.txns[txn_id]
+        return self.commit_frame.pack(self.STREAMED, seq, txn['start_time'],
+                                      len(txn['file'])) + txn['file']
+
+    def restoreCommit(self, txn_id, frame):
+        """ Log the transaction in a SEC_COMMIT frame, ready to commit. """
+        (flags, seq, start_time, name_length) = self.commit_frame.unpack_from(frame)
+        offset = self.commit_frame.size
+        file_name = frame[offset:offset + name_length]
+        offset += name_length
+        if flags & self.STREAMED:
+            # Commit checks that the streamed writes all arrived
+            txn = self.txns.get(txn_id)
+            if txn is None or txn['file'] != file_name:
+                raise Exception(201, "Unknown transaction id.")
+            return
+        lengths = struct.unpack_from("!%dI" % seq, frame, offset)
+        offset += 4 * seq
+        if offset + sum(lengths) != len(frame):
+            raise Exception(204, "Commit frame has the wrong length.")
+        self.discard(txn_id)
+        self.newTxn(file_name, start_time, txn_id)
+        for (k, length) in enumerate(lengths):
+            self.addWrite(txn_id, k, buffer(frame, offset, length))
+            offset += length
+
+    def position(self):
+        """ Returns where the next record will go, as (log_id, segment, offset). """
+        return (self.log_id, self.segment, self.offset)
+
+    def catchUp(self, since):
+        """
+        Returns the position of the log now and an iterator of
+        catchup_records of the transactions finished after since, a
+        position.  Everything, if since is None or from another log.
+        """
+        start = 0
+        if since is not None and since[0] == self.log_id:
+            start = bisect.bisect_right(self.finished,
+                                        (since[1], since[2], sys.maxint))
+        end = len(self.finished)
+        return (self.position(), self.catchUpRecords(start, end))
+
+    def catchUpRecords(self, start, end):
+        for i in xrange(start, end):
+            txn_id = self.finished[i][2]
+            txn = self.txns.get(txn_id)
+            if txn is None or txn['status'] not in ('COMMIT', 'ABORT'):
+                continue
+            status = self.COMMIT if txn['status'] == 'COMMIT' else self.ABORT
+            yield self.catchup_record.pack(
+                txn_id, status, txn['writes_committed'], txn['start_time'],
+                len(txn['file'])) + txn['file']
+
+    def restore(self, txn_id, txn_info):
+        """ Log a transaction received from another server. """
+        self.discard(txn_id)
+        self.newTxn(toBytes(txn_info['file']), txn_info['start_time'], txn_id)
+        # Finished transactions don't need their data
+        if txn_info['status'] == 'NEW_TXN':
+            for seq in sorted(txn_info['writes']):
+                self.addWrite(txn_id, seq, toBytes(txn_info['writes'][seq]))
+        if txn_info['status'] == 'COMMIT':
+            self.commit(txn_id, txn_info['writes_committed'])
+        elif txn_info['status'] == 'ABORT':
+            self.abort(txn_id)
+
+    def get(self, txn_id):
+        return self.txns.get(txn_id)
+
+    def items(self):
+        return self.txns.items()
+
+    def __contains__(self, txn_id):
+        return txn_id in self.txns
+
+    def __repr__(self):
+        return repr(self.txns)
+
+
+class LockManager():
+    """
+    In memory locks keyed by file name, used to serialize commits.
+
+    acquire() returns a Deferred that fires once the lock is held, so
+    waiting commits yield to the reactor.  Waiters get the lock in FIFO
+    order.
+    """
+
+    locks = None  # name -> DeferredLock, only while held or waited on
+
+    def __init__(self):
+        self.locks = {}
+
+    def acquire(self, name):
+        if name not in self.locks:
+            self.locks[name] = defer.DeferredLock()
+        return self.locks[name].acquire()
+
+    def release(self, name):
+        lock = self.locks[name]
+        lock.release()  # Hands the lock to the next waiter, if any
+        if not lock.locked and self.locks.get(name) is lock:
+            del self.locks[name]
+
+    def depth(self, name):
+        """ Number of commits holding or waiting for the lock on name. """
+        lock = self.locks.get(name)
+        if lock is None:
+            return 0
+        return int(lock.locked) + len(lock.waiting)
+
+    def depths(self):
+        return dict([(name, self.depth(name)) for name in self.locks])
+
+
+class ReplicationLag():
+    """
+    Counts the commits and aborts sent to the secondary but not yet
+    answered, for async replication.
+
+    wait() returns a Deferred that fires once the lag is within the
+    limits, so a commit's ACK is held back while the secondary is too far
+    behind.  Waiters are released in FIFO order.
+    """
+
+    txns = 0
+    bytes = 0
+    waiting = None  # Deferreds waiting for the lag to drop
+
+    def __init__(self, max_txns, max_bytes):
+        self.max_txns = max_txns
+        self.max_bytes = max_bytes
+        self.waiting = []
+
+    def add(self, size):
+        self.txns += 1
+        self.bytes += size
+
+    def done(self, size):
+        self.txns -= 1
+        self.bytes -= size
+        while self.waiting and self.within():
+            self.waiting.pop(0).callback(None)
+
+    def within(self):
+        return self.txns <= self.max_txns and self.bytes <= self.max_bytes
+
+    def wait(self):
+        if self.within() and not self.waiting:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def stats(self):
+        return {'txns': self.txns, 'bytes': self.bytes,
+                'waiting': len(self.waiting)}
+
+
+class ReadCache():
+    """
+    Keeps the contents of recently read files in memory, up to max_bytes,
+    dropping the least recently used first.  Files over max_file are not
+    kept.  A commit invalidates its file.
+    """
+
+    max_file = 1024*1024  # Bigger files are streamed from disk
+    size = 0  # Bytes held
+    hits = 0
+    misses = 0
+    evictions = 0
+    files = None  # file name -> contents, least recently used first
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()
+
+    def get(self, name):
+        """ Returns the cached contents of name, or None. """
+        if self.max_bytes <= 0:
+            return None
+        data = self.files.pop(name, None)
+        if data is None:
+            self.misses += 1
+            return None
+        self.files[name] = data  # Now the most recently used
+        self.hits += 1
+        return data
+
+    def fits(self, size):
+        return 0 < self.max_bytes and size <= min(self.max_bytes, self.max_file)
+
+    def put(self, name, data):
+        if not self.fits(len(data)):
+            return
+        self.invalidate(name)
+        while self.size + len(data) > self.max_bytes:
+            (__, old) = self.files.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+        self.files[name] = data
+        self.size += len(data)
+
+    def invalidate(self, name):
+        data = self.files.pop(name, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def stats(self):
+        return {'bytes': self.size, 'files': len(self.files),
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
 
 
 class FilesystemService():
     """ Provides the filesystem functionality: writes and logs transactions. """
 
     logdir = ".server_log/"
-    logfile = logdir+"log"
+    logfile = logdir+"log"  # shelve used by older versions, imported once
+    hash_index = logdir+"hashes"  # Hashes of files, to skip on startup
+    sync_position = logdir+"sync_position"  # How far a secondary has caught up
     lock_prefix = ".lock-"
+    sync_prefix = ".sync-"  # Files being fetched from the primary
+    sync_block_size = 64*1024  # Block size for delta sync checksums
 
     txn_list = None
-    file_list = {}
+    commit_mode = 'copy'
+    hash_algorithm = 'md5'
+    hash_threads = 4
+    sync_connections = 4
+    snapshot_loop = None  # LoopingCall snapshotting the log
+    txn_ttl = 5*60  # seconds a transaction may stay open, 0 for ever
+    reap_batch = 100  # Most expired transactions aborted per reap
+    reap_interval = 5  # seconds between looking for expired transactions
+    reap_loop = None  # LoopingCall aborting expired transactions
+    commit_locks = None
+    commit_pool = None  # Threads doing the file IO of commits
+    file_list = {}  # file name -> hash
+    file_stats = {}  # file name -> [size, mtime, inode] when hashed
+    hashers = {}  # file name -> hasher fed the whole file, at file_stats
+    block_sums = {}  # file name -> [size, mtime, inode, blockSums]
+    hash_pool = None  # Threads computing blockSums for NEW_SEC
     primary_txt = None
 
     role = None
     primary = None  # None if this is the primary
     secondary = None  # None if this is a secondary
+    replication = None  # ReplicationFactory connected to the secondary
+    replication_mode = 'sync'
+    secondary_reads = False  # Does the secondary answer READs?
+    synced = False  # Has the secondary caught up with the primary?
+    syncing = False  # Is the secondary fetching from the primary?
+    channels = None  # Replication channels open from the primary
+    lag = None  # ReplicationLag of async replication
+    read_cache = None  # ReadCache of files sent by READ
+    streamed = None  # txn_id -> seqs of writes sent ahead to the secondary
 
     host = None
     port = None
@@ -446,6 +2065,17 @@ class FilesystemService():
 
         self.host = args.ip
         self.port = args.port
+        self.commit_mode = args.commit_mode
+        self.hash_algorithm = args.hash
+        self.hash_threads = args.hash_threads
+        self.sync_connections = args.sync_connections
+        self.txn_ttl = args.txn_ttl
+        self.reap_batch = args.reap_batch
+        self.replication_mode = args.replication
+        self.channels = set()
+        self.secondary_reads = args.secondary_reads
+        self.lag = ReplicationLag(args.max_lag_txns, args.max_lag_bytes)
+        self.read_cache = ReadCache(args.read_cache)
 
         # Create log directory
         try:
@@ -455,21 +2085,53 @@ class FilesystemService():
                 print "Could not initialize server.  Does the directory have execute permission?"
                 sys.exit(-1)
 
-        # Delete lock files leftover from a crash
-        pattern = "^"+self.lock_prefix+".*$"
+        self.commit_locks = LockManager()
+        self.streamed = {}
+        self.file_stats = {}
+        self.hashers = {}
+        self.block_sums = {}
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      self.saveHashIndex)
+        self.hash_pool = ThreadPool(1, args.hash_threads, "hash")
+        self.hash_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self.hash_pool.stop)
+        self.commit_pool = ThreadPool(1, args.commit_threads, "commit")
+        self.commit_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self.commit_pool.stop)
+
+        # Delete lock files and partial fetches leftover from a crash
+        pattern = "^(%s|%s).*$" % (re.escape(self.lock_prefix),
+                                   re.escape(self.sync_prefix))
         for f in os.listdir(self.logdir):
             if re.search(pattern, f):
                 os.remove(os.path.join(self.logdir, f))
 
-        # If logs exist, read from disk
-        if os.path.isfile(self.logfile):
-            log = shelve.open(self.logfile)
-        else:
-            log = shelve.open(self.logfile)
-            log['next_id'] = 1
-        self.txn_list = log
+        # Replay the log from disk
+        try:
+            self.txn_list = TransactionLog(self.logdir, args.group_commit,
+                                           args.group_commit_max)
+        except IOError as e:
+            print "Could not replay the log: %s" % e
+            sys.exit(-1)
+        if not self.txn_list.txns and glob.glob(self.logfile + "*"):
+            old_log = shelve.open(self.logfile, 'r')
+            for (txn_id, txn) in old_log.items():
+                if txn_id != 'next_id':
+                    self.txn_list.restore(int(txn_id), txn)
+            old_log.close()
+            self.txn_list.sync()
+        self.rollbackCommits()
         if verbosity > 1:
             print "Raw log:", self.txn_list
+        if args.snapshot_interval > 0:
+            self.snapshot_loop = LoopingCall(self.snapshotLog)
+            self.snapshot_loop.start(args.snapshot_interval, now=False)
+        if self.txn_ttl > 0:
+            self.reap_loop = LoopingCall(self.reapTxns)
+            self.reap_loop.start(min(self.reap_interval, self.txn_ttl),
+                                 now=False)
 
         # Read primary.txt
         try:
@@ -505,40 +2167,168 @@ class FilesystemService():
 
     # Run on server shutdown
     def __del__(self):
-        # Abort transactions that were started more than 5 mins ago
+        # Abort transactions that were started more than txn_ttl ago
         if self.txn_list is not None:
-            expire_time = 5*60
-            for (txn_id, txn) in self.txn_list.items():
-                if (txn_id != 'next_id' and
-                    txn['status'] == 'NEW_TXN' and
-                    time.time() > txn['start_time'] + expire_time):
-
-                    txn_info = self.txn_list[str(txn_id)]
-                    txn_info['status'] = 'ABORT'
-                    self.txn_list[str(txn_id)] = txn_info
+            if self.txn_ttl > 0:
+                for txn_id in self.txn_list.openTxns(time.time() - self.txn_ttl):
+                    self.txn_list.abort(txn_id)
             self.txn_list.close()
 
+    def reapTxns(self):
+        """
+        Abort up to reap_batch transactions left open longer than txn_ttl,
+        oldest first, and remove their staged writes.  The next reap waits
+        for these aborts.
+        """
+        if self.role != 'PRIMARY':
+            return  # The secondary gets the primary's aborts
+        # Walk the open transactions, oldest first, only as far as needed.
+        # Aborting changes the index, so that waits until the walk is done.
+        started_before = time.time() - self.txn_ttl
+        expired = []
+        for (start_time, txn_id) in self.txn_list.opened:
+            if start_time >= started_before or len(expired) == self.reap_batch:
+                break
+            # Leave it to a commit to the same file, it may be this one.
+            # Skipped ones don't count, so newer ones aren't held up.
+            if self.commit_locks.depth(self.txn_list.get(txn_id)['file']) > 0:
+                continue
+            expired.append(txn_id)
+        aborts = []
+        for txn_id in expired:
+            if verbosity > 0:
+                print "Aborting expired transaction", txn_id
+            d = self.abortTxn(txn_id, 0)
+            d.addErrback(self.reapFailed, txn_id)
+            aborts.append(d)
+        return defer.DeferredList(aborts)
+
+    def reapFailed(self, reason, txn_id):
+        print "Could not abort expired transaction %d: %s" % (
+            txn_id, reason.getErrorMessage())
+
+    def rollbackCommits(self):
+        """
+        Undo appends in place that were interrupted by a crash, by
+        truncating the file back to the length logged before the commit.
+        The transaction stays open, so the client can commit it again.
+        """
+        for txn_id in self.txn_list.openTxns():
+            txn = self.txn_list.get(txn_id)
+            if 'pre_length' not in txn:
+                continue
+            if verbosity > 0:
+                print "Rolling back partial commit", txn_id, txn['file']
+            self.truncateFile(txn['file'], txn['pre_length'])
+            self.txn_list.rollback(txn_id)
+        self.txn_list.sync()
+
+    def snapshotLog(self):
+        """ Snapshot the log, so its old segments can go. """
+        d = self.txn_list.snapshot()
+        d.addErrback(self.snapshotFailed)
+        return d
+
+    def snapshotFailed(self, reason):
+        print "Could not snapshot the log:", reason.getErrorMessage()
+
+    def truncateFile(self, filename, length):
+        """ Cut filename back to length bytes, or remove it if length is -1. """
+        if length < 0:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        elif os.path.isfile(filename):
+            with open(filename, 'r+b') as f:
+                f.truncate(length)
+                f.flush()
+                os.fsync(f.fileno())
+
     def hashFiles(self):
         """
         Generates a dictionary of filenames and their hashes known to the server.
         """
-        # from http://stackoverflow.com/questions/1131220/get-md5-hash-of-a-files-without-open-it-in-python
-        # def md5_for_file(f, block_size=2**20):
-        #     md5 = hashlib.md5()
-        #     while True:
-        #         data = f.read(block_size)
-        #         if not data:
-        #             break
-        #         md5.update(data)
-        #     return md5.hexdigest()
-        hashs = [(f, hashlib.md5(open(f, 'r').read()).hexdigest())
-                 for f in os.listdir('.')
-                 if not os.path.isdir(f) and f[0] != '.'
-                 ]
-        self.file_list = dict(hashs)
+        # Files unchanged since the index was saved keep their hash
+        try:
+            with open(self.hash_index, 'rb') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        if index.get('algorithm') != self.hash_algorithm:
+            index = {}
+        blocks = {}
+        if index.get('block_size') == self.sync_block_size:
+            blocks = index.get('blocks', {})
+        index = index.get('files', {})
+
+        self.file_list = {}
+        self.file_stats = {}
+        self.block_sums = {}
+        changed = []
+        for f in os.listdir('.'):
+            if os.path.isdir(f) or f[0] == '.':
+                continue
+            stat = self.statFile(f)
+            entry = index.get(f.decode('utf-8', 'replace'))
+            if entry is not None and entry[:3] == stat:
+                self.file_list[f] = str(entry[3])
+            else:
+                changed.append(f)
+            self.file_stats[f] = stat
+            entry = blocks.get(f.decode('utf-8', 'replace'))
+            if entry is not None and entry[:3] == stat:
+                self.block_sums[f] = entry
+
+        # Hash the rest in parallel, hashlib releases the GIL on big updates
+        if changed:
+            pool = HashPool(self.hash_threads)
+            try:
+                hashers = pool.map(
+                    lambda f: hashFile(f, self.hash_algorithm), changed, 1)
+            finally:
+                pool.close()
+            for (f, h) in zip(changed, hashers):
+                self.hashers[f] = h
+                self.file_list[f] = h.hexdigest()
+        self.saveHashIndex()
+        if verbosity > 0:
+            print "Hashed %d files, %d unchanged" % (
+                len(changed), len(self.file_list) - len(changed))
         if verbosity > 1:
             print "Hashes:", self.file_list
 
+    def statFile(self, f):
+        """ Returns what identifies a version of f in the hash index. """
+        st = os.stat(f)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def saveHashIndex(self):
+        """
+        Write the hash index, keyed by file name, size, mtime and inode.
+        The blockSums of files sent with NEW_SEC are kept with it.
+        """
+        files = dict([(f, self.file_stats[f] + [self.file_list[f]])
+                      for f in self.file_list if f in self.file_stats])
+        blocks = dict([(f, self.block_sums[f])
+                       for f in self.file_list if f in self.block_sums])
+        index = {'algorithm': self.hash_algorithm, 'files': files,
+                 'block_size': self.sync_block_size, 'blocks': blocks}
+        tmp = self.hash_index + ".tmp"
+        with open(tmp, 'wb') as f:
+            json.dump(index, f)
+        os.rename(tmp, self.hash_index)
+
+    def fileHasher(self, filename):
+        """
+        Returns a copy of the hasher fed filename's current contents, so a
+        commit can hash only the appended data.  None if it is not known.
+        """
+        if not os.path.isfile(filename):
+            return hash_algorithms[self.hash_algorithm]()
+        if (filename in self.hashers and
+            self.file_stats.get(filename) == self.statFile(filename)):
+            return self.hashers[filename].copy()
+        return None
+
     def becomePrimary(self):
         """
         Become primary server. Run by secondary to switch roles, or on boot.
@@ -583,68 +2373,239 @@ class FilesystemService():
         self.hashFiles()
 
         # Remove NEW_TXNs if secondary
-        for (txn_id, txn) in self.txn_list.items():
-            if (txn_id != 'next_id' and txn['status'] == 'NEW_TXN'):
-                del self.txn_list[str(txn_id)]
+        for txn_id in self.txn_list.openTxns():
+            self.txn_list.forget(txn_id)
+        yield self.txn_list.sync()
         if verbosity > 0:
             print 'Log:', self.txn_list
 
         # Sync files with primary
+        self.syncing = True
         try:
             protocol = yield self.connectToServer(self.primary)
         except Exception, e:
             if verbosity > 0:
                 print "SEC Could not connect to primary. Becoming primary."
+            self.syncing = False
             self.becomePrimary()
             return
+        try:
+            yield self.syncFiles(protocol)
+        except Exception, e:
+            self.syncFailed("files", e)
+            return
+
+        # Sync log, from where the last sync with this log got to
+        try:
+            yield self.catchUp()
+        except Exception, e:
+            self.syncFailed("log", e)
+            return
+
+        if verbosity > 0:
+            print "Log:", self.txn_list
+        self.syncing = False
+        # Without a replication channel yet, sync again once it opens
+        self.synced = bool(self.channels)
+
+        # Setup heartbeat
+        self.setupHeartbeat()
+        self.heartbeatd.addCallback(self.lostPrimary)
+
+    @defer.inlineCallbacks
+    def syncFiles(self, protocol):
+        """ Announce the secondary over protocol, and fetch what it lacks. """
         if verbosity > 1:
             print "SEC files:", self.file_list
-        j = json.dumps(self.file_list)
-        j = yield protocol.sendNEW_SEC(self.host, self.port, j)
+        index = yield self.blockIndex()
+        j = yield protocol.sendNEW_SEC(self.host, self.port, json.dumps(index))
 
         files = json.loads(j)
-        files = map(str, files)
+        files = dict([(str(k), files[k]) for k in files])
         if verbosity > 1:
             print "SEC getting files:", files
-        for fname in files:
-            try:
-                protocol = yield self.connectToServer(self.primary)
-                buf = yield protocol.sendREAD(fname)
-            except Exception, e:
-                self.lostPrimary()
-                return
+        yield self.fetchFiles(files)
 
-            if verbosity > 2:
-                print "SEC writing file:", fname
-                print "SEC writing data:", buf
-            with open(fname, 'w') as f:
-                f.write(buf)
+    def channelOpened(self, channel):
+        """
+        The primary opened a replication channel.  If replication had
+        stopped, commits may have been missed, so sync again.
+        """
+        self.channels.add(channel)
+        if self.role == 'SECONDARY' and not self.synced and not self.syncing:
+            self.resync()
+
+    def channelClosed(self, channel):
+        """ A replication channel closed.  READs go to the primary until a new one opens. """
+        self.channels.discard(channel)
+        if not self.channels and self.synced:
+            if verbosity > 0:
+                print "SEC replication from the primary stopped"
+            self.synced = False
 
-        # Sync log
+    @defer.inlineCallbacks
+    def resync(self):
+        """
+        Fetch the files and log records missed while replication had
+        stopped.  A failure leaves the secondary unsynced; the heartbeat
+        decides whether the primary is gone.
+        """
+        self.syncing = True
         try:
             protocol = yield self.connectToServer(self.primary)
+            yield self.syncFiles(protocol)
+            yield self.catchUp()
+            self.synced = bool(self.channels)
+            if verbosity > 0:
+                print "SEC synced with the primary again"
         except Exception, e:
+            print "SEC Could not sync with the primary again: %s" % e
+        finally:
+            self.syncing = False
+
+    def syncFailed(self, what, e):
+        """
+        Syncing with the primary failed.  Only take over if the primary
+        can't be reached.  Otherwise it is still up, so stop rather than
+        run as a second primary.
+        """
+        if isinstance(e, error.ConnectError):
             if verbosity > 0:
-                print "SEC Could not connect to primary. Becoming primary."
+                print "SEC Could not connect to primary to sync %s. Becoming primary." % what
             self.becomePrimary()
             return
-        j = yield protocol.sendSYNC_LOG()
-        new_log = json.loads(j)
-        new_log = dict([(str(k), new_log[k]) for k in new_log])
-        if verbosity > 1:
-            print "Log items from primary:", new_log
-        for txn_id in new_log:
-            txn = new_log[txn_id]
-            txn = dict([(str(k), txn[k]) for k in txn])
-            txn['writes'] = dict([(int(k), txn['writes'][k]) for k in txn['writes']])
-            self.txn_list[txn_id] = txn
+        print "SEC Could not sync %s: %s. Stopping." % (what, e)
+        reactor.callWhenRunning(reactor.stop)
 
+    @defer.inlineCallbacks
+    def catchUp(self):
+        """
+        Restore the transactions the primary finished since the saved
+        position, then save the position reached.
+        """
+        since = None
+        try:
+            with open(self.sync_position, 'rb') as f:
+                saved = json.load(f)
+            # Only good while this server's own log is the same
+            if saved['log_id'] == self.txn_list.log_id:
+                since = map(toBytes, saved['primary'][:1]) + saved['primary'][1:]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        (host, port) = self.primary
+        connection = ClientCreator(reactor, CatchUpProtocol, since,
+                                   self.txn_list.restore)
+        protocol = yield connection.connectTCP(host, port)
+        position = yield protocol.deferred
+        yield self.txn_list.sync()
         if verbosity > 0:
-            print "Log:", self.txn_list
+            print "SEC restored %d log records from the primary" % protocol.count
 
-        # Setup heartbeat
-        self.setupHeartbeat()
-        self.heartbeatd.addCallback(self.lostPrimary)
+        tmp = self.sync_position + ".tmp"
+        with open(tmp, 'wb') as f:
+            json.dump({'log_id': self.txn_list.log_id,
+                       'primary': list(position)}, f)
+        os.rename(tmp, self.sync_position)
+
+    @defer.inlineCallbacks
+    def blockIndex(self):
+        """
+        Returns a Deferred firing with each file's hash and blockSums, for
+        NEW_SEC, so the primary can send only the blocks that differ.  The
+        sums are kept in the hash index, and only files changed since are
+        read again, in the hash thread pool.
+        """
+        stats = dict([(f, self.statFile(f)) for f in self.file_list])
+        changed = sorted([f for f in stats
+                          if self.block_sums.get(f, [])[:3] != stats[f]])
+        if changed:
+            d = defer.DeferredList([threads.deferToThreadPool(
+                reactor, self.hash_pool, blockSums, f, self.hash_algorithm,
+                self.sync_block_size) for f in changed],
+                fireOnOneErrback=True, consumeErrors=True)
+            d.addErrback(lambda reason: reason.value.subFailure)
+            sums = yield d
+            # Stat from before reading, so a commit meanwhile reads it again
+            for (f, (__, b)) in zip(changed, sums):
+                self.block_sums[f] = stats[f] + [b]
+            self.saveHashIndex()
+        if verbosity > 0:
+            print "Summed blocks of %d files, %d unchanged" % (
+                len(changed), len(stats) - len(changed))
+        defer.returnValue(dict([(f, {'hash': self.file_list[f],
+                                     'size': stats[f][0],
+                                     'block_size': self.sync_block_size,
+                                     'blocks': self.block_sums[f][3]})
+                                for f in stats]))
+
+    def fetchFiles(self, files):
+        """
+        Fetch files (name -> [size on the primary, ranges to fetch]) from the
+        primary, sync_connections at a time.  Returns a Deferred that fails
+        if any do.
+        """
+        progress = {'files': 0, 'bytes': 0, 'start': time.time()}
+        total = sum([sum([length for (offset, length) in ranges])
+                     for (size, ranges) in files.values()])
+        if verbosity > 0:
+            print "SEC fetching %d bytes of %d files, keeping %d bytes" % (
+                total, len(files),
+                sum([size for (size, ranges) in files.values()]) - total)
+        semaphore = defer.DeferredSemaphore(max(1, self.sync_connections))
+        fetches = [semaphore.run(self.fetchFile, fname, files[fname][0],
+                                 files[fname][1], progress, len(files), total)
+                   for fname in sorted(files)]
+        d = defer.DeferredList(fetches, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addErrback(lambda reason: reason.value.subFailure)
+        return d
+
+    @defer.inlineCallbacks
+    def fetchFile(self, fname, size, ranges, progress, total_files,
+                  total_bytes):
+        """
+        Stream the given ranges of fname from the primary.  A file the
+        secondary already has is patched in place, a new one is written to a
+        temporary file and moved into place.  Then it is hashed again.
+        """
+        if os.path.isfile(fname):
+            path = fname
+        else:
+            path = os.path.join(self.logdir, self.sync_prefix + fname)
+        with open(path, 'ab') as f:
+            f.truncate(size)
+        (host, port) = self.primary
+        received = 0
+        for (offset, length) in ranges:
+            connection = ClientCreator(reactor, FetchProtocol, fname, path,
+                                       offset, length)
+            protocol = yield connection.connectTCP(host, port)
+            got = yield protocol.deferred
+            if got < length:
+                raise Exception(208, "Got %d of %d bytes of %s at %d" % (
+                    got, length, fname, offset))
+            received += got
+        if path != fname:
+            os.rename(path, fname)
+        # READs and the next NEW_SEC have to see the new contents
+        self.read_cache.invalidate(fname)
+        stat = self.statFile(fname)
+        hasher = yield threads.deferToThreadPool(
+            reactor, self.hash_pool, hashFile, fname, self.hash_algorithm)
+        self.hashers[fname] = hasher
+        self.file_list[fname] = hasher.hexdigest()
+        self.file_stats[fname] = stat
+
+        progress['files'] += 1
+        progress['bytes'] += received
+        # Every file when debugging, otherwise every 100 and the last
+        done = progress['files']
+        if verbosity > 1 or (verbosity > 0 and
+                             (done % 100 == 0 or done == total_files)):
+            elapsed = max(time.time() - progress['start'], 0.001)
+            print "SEC synced %s: %d/%d files, %d/%d bytes, %.1f KB/s" % (
+                fname, progress['files'], total_files, progress['bytes'],
+                total_bytes, progress['bytes'] / elapsed / 1024)
 
     def connectToServer(self, (host,port)):
         """ Establish connection from secondary to primary. Return Deferred. """
@@ -667,127 +2628,288 @@ class FilesystemService():
 
     def addSecondary(self, host, port, files):
         """
-        Adds a secondary to the primary.  Returns a list of files that differ,
-        comparing the provided list and the primary's files.
+        Adds a secondary to the primary.  Returns a Deferred of the files that
+        differ, comparing the provided list and the primary's files, with the
+        ranges the secondary has to fetch.
         """
-        self.secondary = (host,port)
         if verbosity > 0:
             print "PRI added secondary", host, port
+        # A secondary syncing again keeps its replication channel
+        if self.replication is None or self.secondary != (host, port):
+            if self.replication is not None:
+                self.replication.stop()
+            self.replication = ReplicationFactory()
+            reactor.connectTCP(host, port, self.replication)
+        self.secondary = (host,port)
 
         # Compare given files with own files
         sec_files = json.loads(files)
-        diff_files = {}
         sec_files = dict([(str(k), sec_files[k]) for k in sec_files])
+        # Commits change file_list, so the thread gets a copy, with sizes
+        # to read up to
+        local_files = dict([(f, (self.file_list[f], os.path.getsize(f)))
+                            for f in self.file_list])
+        d = threads.deferToThread(self.diffFiles, sec_files, local_files)
+        d.addCallback(json.dumps)
+        return d
 
-        for local_file in self.file_list:
-            if local_file not in sec_files or \
-                self.file_list[local_file] != sec_files[local_file]:
-                diff_files[local_file] = None
+    def diffFiles(self, sec_files, local_files):
+        """
+        Returns {file: [size, ranges]} for the files of local_files
+        (name -> (hash, size)) that sec_files, a secondary's NEW_SEC list,
+        lacks.  Run in a thread, as it reads differing files.
+        """
+        diff_files = {}
+        for (local_file, (local_hash, size)) in local_files.items():
+            sec = sec_files.get(local_file)
+            if isinstance(sec, dict):
+                sec_hash = sec.get('hash')
+            else:
+                sec_hash = sec  # Older secondaries send only the hash
+            if sec is not None and local_hash == sec_hash:
+                continue
+            if (isinstance(sec, dict) and
+                sec.get('block_size') == self.sync_block_size):
+                ranges = fileDelta(local_file, sec['blocks'],
+                                   self.hash_algorithm, self.sync_block_size,
+                                   size, sec.get('size'))
+            else:
+                ranges = [[0, size]]
+            diff_files[local_file] = [size, ranges]
 
         if verbosity > 1:
             print "PRI differing files:", diff_files
-        j = json.dumps(diff_files)
-        return j
+        return diff_files
 
     def removeSecondary(self, (d,)):
         if verbosity > 0:
             print "PRI removing secondary"  # host, port
         # TODO do this properly
         self.secondary = None
+        if self.replication is not None:
+            self.replication.stop()
+            self.replication = None
+        self.streamed.clear()
         self.heartbeatd = d
         self.heartbeatd.addCallback(self.removeSecondary)
 
-    def syncLog(self):
-        log = {}
-        for (txn_id, txn) in self.txn_list.items():
-            if (txn_id != 'next_id' and
-                (txn['status'] == 'COMMIT' or txn['status'] == 'ABORT')):
-                log[txn_id] = self.txn_list[str(txn_id)]
-        j = json.dumps(log)
-        return j
-
-    def readFile(self, file_name):
-        """ Read file_name. """
+    def stats(self):
+        """ Returns counters describing the server, for STATS. """
+        return {'role': self.role,
+                'commit_queues': self.commit_locks.depths(),
+                'replication': self.replication_mode,
+                'replication_lag': self.lag.stats(),
+                'read_cache': self.read_cache.stats()}
+
+    def replicate(self, method, txn_id, seq, buf):
+        """
+        Send SEC_COMMIT or SEC_ABORT over the replication channel.  Returns
+        a Deferred of the secondary's reply, or of None if it can't be
+        reached.
+        """
+        if self.replication is None:
+            return defer.succeed(None)
+        d = self.replication.request(method, txn_id, seq, buf)
+        d.addErrback(self.replicationLost)
+        return d
+
+    def replicateLater(self, d, size):
+        """
+        Count d, a request of size bytes to the secondary, toward the lag of
+        async replication.  Returns a Deferred that fires once the secondary
+        is no more than the allowed lag behind.
+        """
+        self.lag.add(size)
+        d.addErrback(self.replicationFailed)
+        d.addBoth(lambda _: self.lag.done(size))
+        return self.lag.wait()
+
+    def replicationFailed(self, reason):
+        print "ERR replication failed on the secondary:", reason.getErrorMessage()
+
+    @defer.inlineCallbacks
+    def replicateCommit(self, txn_id, seq, extents, discard=False):
+        """
+        Send SEC_COMMIT.  If all the writes were streamed to the secondary,
+        only a marker is sent, and the data only if the secondary lacks
+        some.  With discard the staging file is removed afterwards.
+        """
+        streamed = self.streamed.pop(txn_id, set())
+        try:
+            if self.replication is None:
+                defer.returnValue(None)
+            if set(range(seq)) <= streamed:
+                d = self.replicate('SEC_COMMIT', txn_id, seq,
+                                   self.txn_list.commitMarker(txn_id, seq))
+                d.addErrback(lambda _: ('ERROR', None))
+                reply = yield d
+                if reply is None or reply[0] == 'ACK':
+                    defer.returnValue(reply)
+                if verbosity > 1:
+                    print "PRI resending the writes of", txn_id
+            frame = self.txn_list.exportCommit(txn_id, seq, extents)
+            reply = yield self.replicate('SEC_COMMIT', txn_id, seq, frame)
+            defer.returnValue(reply)
+        finally:
+            if discard:
+                self.txn_list.discard(txn_id)
+
+    def streamToSecondary(self, method, txn_id, seq, buf):
+        """
+        Send SEC_NEW_TXN or SEC_WRITE ahead of the commit, without waiting.
+        If it fails, the commit sends the data instead.
+        """
+        d = self.replicate(method, txn_id, seq, buf)
+        d.addErrback(lambda _: self.streamed.pop(txn_id, None))
+
+    def streamNewTxn(self, txn_id, payload):
+        """ Log a transaction the primary started, for SEC_NEW_TXN. """
+        (file_name, start_time) = self.txn_list.unpackNewTxn(payload)
+        self.txn_list.discard(txn_id)
+        self.txn_list.newTxn(file_name, start_time, txn_id)
+        return ('ACK', None)
+
+    def streamWrite(self, txn_id, seq, buf):
+        """
+        Stage a write the primary received, for SEC_WRITE.  The log is
+        synced by the commit.
+        """
+        txn = self.txn_list.get(txn_id)
+        if txn is None or txn['status'] != 'NEW_TXN':
+            raise Exception(201, "Unknown transaction id.")
+        self.txn_list.addWrite(txn_id, seq, buf)
+        return ('ACK', None)
+
+    def replicationLost(self, reason):
+        reason.trap(error.ConnectError, error.ConnectionLost,
+                    error.ConnectionDone)
+        if verbosity > 0:
+            print "No secondary, despite heartbeat."
+        return None
+
+    def syncLog(self, since):
+        """
+        Returns the log position now and the catch up records of the
+        transactions finished after since, for SYNC_LOG.
+        """
+        return self.txn_list.catchUp(since)
+
+    def readFile(self, file_name, min_txn=0):
+        """
+        Open file_name for reading.  Returns the open file on success, or
+        its contents as a file from the read cache.  A secondary only
+        answers once transaction min_txn is committed or aborted here.
+        """
         if self.role == 'SECONDARY':
-            return (207, "Connect to primary at %s:%d" % self.primary)
+            if not (self.secondary_reads and self.synced and self.channels):
+                return (207, "Connect to primary at %s:%d" % self.primary)
+            if min_txn > 0:
+                txn = self.txn_list.get(min_txn)
+                if txn is None or txn['status'] == 'NEW_TXN':
+                    return (207, "Transaction %d not applied, connect to primary at %s:%d" % (
+                            (min_txn,) + self.primary))
+        data = self.read_cache.get(file_name)
+        if data is not None:
+            return (0, StringIO(data))
         if not os.path.isfile(file_name):
             return (206, "File not found.")
         if verbosity > 1:
             print "READ", file_name
 
         try:
-            f = open(file_name, 'r')
+            f = open(file_name, 'rb')
         except:
             return (205, "Unable to open file.  Check server settings.")
 
-        try:
-            buf = f.read(102400)  # Only read up to 100KB
-        except:
-            return (205,
-                    "File IO error.  Check server settings and permissions.")
-        finally:
-            f.close()
-
-        return (0, buf)
+        if self.read_cache.fits(os.fstat(f.fileno()).st_size):
+            with f:
+                data = f.read()
+            self.read_cache.put(file_name, data)
+            return (0, StringIO(data))
+        return (0, f)
 
+    @defer.inlineCallbacks
     def startNewTxn(self, new_file):
         """ Create and log a new transaction on new_file. """
         # Error checking
         if self.role == 'SECONDARY':
-            return (0, 207, "Connect to primary at %s:%d" % self.primary)
+            raise Exception(207, "Connect to primary at %s:%d" % self.primary)
         if os.path.isdir(new_file):
-            return (0, 205, "A directory with that name already exists.")
+            raise Exception(205, "A directory with that name already exists.")
         if new_file[0] == '.':
-            return (0, 202, "Creating hidden files is forbidden.")
+            raise Exception(202, "Creating hidden files is forbidden.")
         if '/' in new_file:
-            return (0, 202, "Creating directories (or files in subdirectories) is forbidden.")
-
-        # New transaction information
-        # TODO TEST THIS
-        txn_id = self.txn_list['next_id']
-        while (str(txn_id) in self.txn_list):
-            txn_id+=1
-
-        txn_info = {'file': new_file,
-                    'status': 'NEW_TXN',
-                    'writes': {},
-                    'writes_committed': -1,
-                    'start_time': time.time()}
+            raise Exception(202, "Creating directories (or files in subdirectories) is forbidden.")
 
         # Update log
-        self.txn_list['next_id'] = txn_id + 1
-        self.txn_list[str(txn_id)] = txn_info
+        txn_id = self.txn_list.newTxn(new_file)
+        # Its writes go to the secondary as they arrive
+        if self.replication is not None:
+            self.streamed[txn_id] = set()
+            self.streamToSecondary('SEC_NEW_TXN', txn_id, 0,
+                                   self.txn_list.newTxnPayload(txn_id))
 
         # Flush log to disk
-        self.txn_list.sync()
-        self.txn_list.sync()
+        yield self.txn_list.sync()
 
         if verbosity > 0:
-            print 'Log:', self.txn_list[str(txn_id)]
-        return (txn_id, 0, None)
+            print 'Log:', self.txn_list.get(txn_id)
+        defer.returnValue(txn_id)
 
-    def saveWrite(self, txn_id, seq, buf):
-        """ Add a write to txn_id identified by seq with data buf. """
-        # Error checking
+    def checkWritable(self, txn_id):
+        """ Raise the error a write to txn_id gets, if it can't be added. """
         if self.role == 'SECONDARY':
-            return (207, "Connect to primary at %s:%d" % self.primary)
-        if str(txn_id) not in self.txn_list:
-            return (201, "Unknown transaction id.")
+            raise Exception(207, "Connect to primary at %s:%d" % self.primary)
+        if txn_id not in self.txn_list:
+            raise Exception(201, "Unknown transaction id.")
 
-        txn_info = self.txn_list[str(txn_id)]
+        txn_info = self.txn_list.get(txn_id)
         if txn_info['status'] == 'ABORT':
-            return (202, "Transaction has been aborted.")
+            raise Exception(202, "Transaction has been aborted.")
         elif txn_info['status'] == 'COMMIT':
-            return (202, "Transaction has been comitted already.")
+            raise Exception(202, "Transaction has been comitted already.")
+
+    def sendAhead(self, txn_id, seq, buf):
+        """ Send a staged write to the secondary, ahead of the commit. """
+        if txn_id in self.streamed:
+            self.streamed[txn_id].add(seq)
+            self.streamToSecondary('SEC_WRITE', txn_id, seq, buf)
+
+    @defer.inlineCallbacks
+    def saveWrite(self, txn_id, seq, buf):
+        """ Add a write to txn_id identified by seq with data buf. """
+        self.checkWritable(txn_id)
 
         # Write to log
-        txn_info['writes'][seq] = buf
-        self.txn_list[str(txn_id)] = txn_info
-        self.txn_list.sync()
+        self.txn_list.addWrite(txn_id, seq, buf)
+        self.sendAhead(txn_id, seq, buf)
+        yield self.txn_list.sync()
 
         if verbosity > 0:
-            print 'Log:', self.txn_list[str(txn_id)]
-        return (0, None)
+            print 'Log:', self.txn_list.get(txn_id)
+
+    @defer.inlineCallbacks
+    def saveWrites(self, txn_id, count, writes):
+        """
+        Add the (seq, buf) writes of a WRITE_BATCH to txn_id, with one sync
+        for them all.  Asks for any of the first count writes still missing.
+        """
+        self.checkWritable(txn_id)
+
+        self.txn_list.addWrites(txn_id, writes)
+        for (seq, buf) in writes:
+            self.sendAhead(txn_id, seq, buf)
+        yield self.txn_list.sync()
+
+        if verbosity > 0:
+            print 'Log: %d writes to' % len(writes), self.txn_list.get(txn_id)
+        txn_info = self.txn_list.get(txn_id)
+        if txn_info['status'] != 'NEW_TXN':  # Finished while syncing
+            defer.returnValue( ('ACK', None) )
+        unsent = [k for k in range(0, count) if k not in txn_info['writes']]
+        if unsent:
+            defer.returnValue( ('ASK_RESEND', unsent) )
+        defer.returnValue( ('ACK', None) )
 
     @defer.inlineCallbacks
     def abortTxn(self, txn_id, seq, override=False):
@@ -795,37 +2917,59 @@ class FilesystemService():
         # Error checking
         if self.role == 'SECONDARY' and not override:
             raise Exception (207, "Connect to primary at %s:%d" % self.primary)
-        if str(txn_id) not in self.txn_list:
+        if txn_id not in self.txn_list:
             raise Exception (201, "Unknown transaction id.")
-        txn_info = self.txn_list[str(txn_id)]
+        txn_info = self.txn_list.get(txn_id)
 
         if txn_info['status'] == 'COMMIT':
             raise Exception (202, "Transaction has been comitted already.")
 
-        # Sync to secondary
-        if self.secondary is not None:
-            try:
-                protocol = yield self.connectToServer(self.secondary)
-            except:
-                if verbosity > 0:
-                    print "No secondary, despite heartbeat."
-            else:
-                cb_txn_info = copy.deepcopy(txn_info)
-                j = json.dumps(txn_info)
-                # needs error checking
-                yield protocol.sendSEC_ABORT(txn_id, seq, j)
+        # Wait for a commit to the same file, which may be this transaction
+        filename = txn_info['file']
+        yield self.commit_locks.acquire(filename)
+        try:
+            (result, lagging) = yield self.applyAbort(txn_id, seq)
+        finally:
+            self.commit_locks.release(filename)
+        # Wait for an async secondary without holding up the file's commits
+        if lagging is not None:
+            yield lagging
+        defer.returnValue(result)
 
-        # Update status
-        txn_info['status'] = 'ABORT'
+    @defer.inlineCallbacks
+    def applyAbort(self, txn_id, seq):
+        """
+        Abort transaction txn_id.  Needs its file's lock.  Returns the reply,
+        and a Deferred to wait on once the lock is released, firing when an
+        async secondary is within its lag, or None.
+        """
+        # The same transaction may have been committed or aborted while
+        # waiting, by the client or the reaper
+        status = self.txn_list.get(txn_id)['status']
+        if status == 'COMMIT':
+            raise Exception (202, "Transaction has been comitted already.")
+        elif status == 'ABORT':
+            yield self.txn_list.sync()
+            defer.returnValue( (('ACK', None), None) )
+
+        # Sync to secondary, which only needs the id of an aborted txn
+        self.streamed.pop(txn_id, None)
+        if self.secondary is not None and self.replication_mode == 'sync':
+            yield self.replicate('SEC_ABORT', txn_id, seq, "")
 
         # Write to log, write out
-        self.txn_list[str(txn_id)] = txn_info
-        self.txn_list.sync()
+        self.txn_list.abort(txn_id)
+        yield self.txn_list.sync()
+        self.txn_list.discard(txn_id)
+        lagging = None
+        if self.secondary is not None and self.replication_mode == 'async':
+            lagging = self.replicateLater(
+                self.replicate('SEC_ABORT', txn_id, seq, ""), 0)
 
         if verbosity > 0:
-            print 'Log:', self.txn_list[str(txn_id)]
+            print 'Log:', self.txn_list.get(txn_id)
 
-        defer.returnValue( ('ACK', None) )
+        defer.returnValue( (('ACK', None), lagging) )
 
     @defer.inlineCallbacks
     def commitTxn(self, txn_id, seq, override=False):
@@ -833,13 +2977,15 @@ class FilesystemService():
         # Error checking
         if self.role == 'SECONDARY' and not override:
             raise Exception(207, "Connect to primary at %s:%d" % self.primary)
-        if str(txn_id) not in self.txn_list:
+        if txn_id not in self.txn_list:
             raise Exception(201, "Unknown transaction id.")
-        txn_info = self.txn_list[str(txn_id)]
+        txn_info = self.txn_list.get(txn_id)
 
         if txn_info['status'] == 'ABORT':
             raise Exception(202, "Transaction has been aborted already.")
         elif txn_info['status'] == 'COMMIT':  # Don't recheck sequence number
+            # Its COMMIT record may still be waiting for the group's fsync
+            yield self.txn_list.sync()
             defer.returnValue( ('ACK', None) )
 
         # Check that have right number of writes
@@ -847,49 +2993,120 @@ class FilesystemService():
         if len(unsent) != 0:
             defer.returnValue( ('ASK_RESEND', unsent) )
 
-        # Write to the file
+        # Wait for other commits to the same file
+        filename = txn_info['file']
+        if verbosity > 1 and self.commit_locks.depth(filename) > 0:
+            print 'locked', txn_id, filename
+        yield self.commit_locks.acquire(filename)
+        try:
+            (result, lagging) = yield self.applyCommit(txn_id, seq)
+        finally:
+            self.commit_locks.release(filename)
+        # Wait for an async secondary without holding up the file's commits
+        if lagging is not None:
+            yield lagging
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def applyCommit(self, txn_id, seq):
+        """
+        Write transaction txn_id to its file.  Needs the file's lock.
+        Returns the reply, and a Deferred to wait on once the lock is
+        released, firing when an async secondary is within its lag, or None.
+        """
+        # The same transaction may have been committed while waiting
+        txn_info = self.txn_list.get(txn_id)
+        if txn_info['status'] == 'ABORT':
+            raise Exception(202, "Transaction has been aborted already.")
+        elif txn_info['status'] == 'COMMIT':
+            yield self.txn_list.sync()
+            defer.returnValue( (('ACK', None), None) )
 
         filename = txn_info['file']
         lock_file = self.logdir + self.lock_prefix + filename  # Make this a hash??
-        data = "".join(
-            [txn_info['writes'][k] for k in txn_info['writes'] if k < seq])
+        writes = sorted([k for k in txn_info['writes'] if k < seq])
+        extents = []
+        if writes:
+            extents = self.txn_list.extents(txn_id, writes)
+
+        # Sync to secondary, unless it is done after the commit
+        replicate_later = (self.secondary is not None and
+                           self.replication_mode == 'async')
+        if self.secondary is not None and not replicate_later:
+            yield self.replicateCommit(txn_id, seq, extents)
+
+        # Write the file in the thread pool, so the reactor keeps serving
+        staging_file = self.txn_list.stagingPath(txn_id)
+        hasher = self.fileHasher(filename)
+        try:
+            if self.commit_mode == 'append':
+                # Log the old length first, so a crash can be undone
+                pre_length = -1
+                if os.path.isfile(filename):
+                    pre_length = os.path.getsize(filename)
+                self.txn_list.precommit(txn_id, pre_length)
+                yield self.txn_list.sync()
+                hasher = yield threads.deferToThreadPool(
+                    reactor, self.commit_pool, self.appendFile, filename,
+                    pre_length, staging_file, extents, hasher)
+            else:
+                hasher = yield threads.deferToThreadPool(
+                    reactor, self.commit_pool, self.writeFile, filename,
+                    lock_file, staging_file, extents, hasher)
+        except:
+            self.read_cache.invalidate(filename)
+            if self.commit_mode == 'append':
+                self.txn_list.rollback(txn_id)
+                yield self.txn_list.sync()
+            raise Exception(205,
+                    "File IO error.  Check server settings and permissions.")
+        # A READ while the file was written may have cached part of it
+        self.read_cache.invalidate(filename)
 
-        # If the lock file exists, another transaction is comitting
-        # TODO Use deferred here
-        while os.path.isfile(lock_file):
-            print 'locked', txn_id
-            time.sleep(0.05)
+        # Write to log, write out.  The staging file stays until an async
+        # replication has sent the data.
+        self.txn_list.commit(txn_id, seq)
+        yield self.txn_list.sync()
+        if not replicate_later:
+            self.txn_list.discard(txn_id)
 
-        # Sync to secondary
-        if self.secondary is not None:
-            try:
-                protocol = yield self.connectToServer(self.secondary)
-            except:
-                if verbosity > 0:
-                    print "No secondary, despite heartbeat."
-            else:
-                cb_txn_info = copy.deepcopy(txn_info)
-                j = json.dumps(txn_info)
-                # needs error checking
-                yield protocol.sendSEC_COMMIT(txn_id, seq, j)
+        # Update file hash
+        self.hashers[filename] = hasher
+        self.file_list[filename] = hasher.hexdigest()
+        self.file_stats[filename] = self.statFile(filename)
+
+        lagging = None
+        if replicate_later:
+            size = sum([length for (offset, length) in extents])
+            lagging = self.replicateLater(self.replicateCommit(
+                txn_id, seq, extents, discard=True), size)
+
+        if verbosity > 0:
+            print 'Log:', self.txn_list.get(txn_id)
+
+        defer.returnValue( (('ACK', None), lagging) )
 
+    def writeFile(self, filename, lock_file, staging_file, extents, hasher):
+        """
+        Append the extents of staging_file to filename, through lock_file.
+        Runs in the commit thread pool.  Returns hasher updated with the
+        appended data, or a new hasher of the whole file if hasher is None.
+        """
         try:
             # Copy existing file to lock
             if os.path.isfile(filename):
                 shutil.copy2(filename, lock_file)
-            # Write data
-            f = open(lock_file, 'a')
-            f.write(data)
+            # Write data, streamed from the staging file
+            f = open(lock_file, 'ab')
+            for chunk in readExtents(staging_file, extents):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
             f.flush()
             os.fsync(f.fileno())
-            txn_info['status'] = 'COMMIT'
-            txn_info['writes_committed'] = seq
 
             # Copy back
             shutil.move(lock_file, filename)
-        except:
-            raise Exception(205,
-                    "File IO error.  Check server settings and permissions.")
         finally:
             try:
                 f.close()
@@ -900,28 +3117,43 @@ class FilesystemService():
             except:
                 pass
 
-        # Write to log, write out
-        self.txn_list[str(txn_id)] = txn_info
-        self.txn_list.sync()
+        if hasher is None:
+            hasher = hashFile(filename, self.hash_algorithm)
+        return hasher
 
-        # Update file hash
-        self.file_list[filename] = hashlib.md5(open(filename, 'r').read()).hexdigest()
-
-        if verbosity > 0:
-            print 'Log:', self.txn_list[str(txn_id)]
+    def appendFile(self, filename, pre_length, staging_file, extents, hasher):
+        """
+        Append the extents of staging_file to filename in place.  Runs in
+        the commit thread pool.  On failure the file is cut back to
+        pre_length.  Returns the hasher like writeFile.
+        """
+        try:
+            with open(filename, 'ab') as f:
+                for chunk in readExtents(staging_file, extents):
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except:
+            self.truncateFile(filename, pre_length)
+            raise
 
-        defer.returnValue( ('ACK', None) )
+        if hasher is None:
+            hasher = hashFile(filename, self.hash_algorithm)
+        return hasher
 
     @defer.inlineCallbacks
-    def writeLog(self, action, txn_id, seq, log):
-        j = json.loads(log)
-        # Convert dict keys from unicode strings to correct type
-        j = dict([(str(k), j[k]) for k in j])
-        j['writes'] = dict([(int(k), j['writes'][k]) for k in j['writes']])
-        self.txn_list[str(txn_id)] = j
+    def writeLog(self, action, txn_id, seq, frame):
+        """ Apply a SEC_COMMIT or SEC_ABORT from the primary. """
         if action == 'COMMIT':
+            self.txn_list.restoreCommit(txn_id, frame)
             (result, reason) = yield self.commitTxn(txn_id, seq, override=True)
         elif action == 'ABORT':
+            # Nothing was staged for a transaction never streamed here, and
+            # only the id is sent, so there is nothing to log
+            if txn_id not in self.txn_list:
+                defer.returnValue( ('ACK', None) )
             (result, reason) = yield self.abortTxn(txn_id, seq, override=True)
         defer.returnValue( (result, reason) )
 
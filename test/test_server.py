@@ -1,6 +1,15 @@
-from a2.server import ServerFactory, Server
+from a2.server import TransactionLog, LockManager
+from a2.server import ReplicationLag, ReadCache
+from a2.server import blockSums, fileDelta, splitBatch
+from a2.server import FilesystemService, FilesystemProtocol
+from a2 import server
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import defer, protocol
 from twisted.trial import unittest
 from twisted.test import proto_helpers
+import os
+import json
+import hashlib
 
 
 
@@ -62,4 +71,572 @@ class ServerTestCase(unittest.TestCase):
         return self._test(send, expected)
 
 
+class TransactionLogTestCase(unittest.TestCase):
 
+    def setUp(self):
+        self.logdir = self.mktemp()
+        os.makedirs(self.logdir)
+
+    def test_replay(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.addWrite(txn_id, 0, "hello")
+        log.commit(txn_id, 1)
+        log.close()
+
+        log = TransactionLog(self.logdir)
+        txn = log.get(txn_id)
+        self.assertEqual(txn['file'], "test.txt")
+        self.assertEqual(txn['status'], 'COMMIT')
+        self.assertEqual(txn['writes_committed'], 1)
+        self.assertEqual(log.newTxn("other.txt"), txn_id + 1)
+
+    def test_staged_writes(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.addWrite(txn_id, 1, "world")
+        log.addWrite(txn_id, 0, "hi ")
+        log.addWrite(txn_id, 0, "hello ")  # Resent write replaces the old one
+        log.close()
+
+        log = TransactionLog(self.logdir)
+        self.assertEqual("".join(log.readWrites(txn_id, [0, 1])),
+                         "hello world")
+        log.discard(txn_id)
+        self.assertFalse(os.path.exists(log.stagingPath(txn_id)))
+
+    def test_write_batch(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.addWrites(txn_id, [(1, "world"), (0, "hello ")])
+        log.addWrites(txn_id, [(2, "!"), (3, "?")])
+        log.close()
+        # Cut the last batch short, as a crash while logging it would
+        with open(log.segmentPath(log.segment), 'r+b') as f:
+            f.truncate(os.path.getsize(log.segmentPath(log.segment)) - 1)
+
+        log = TransactionLog(self.logdir)
+        self.assertEqual(sorted(log.get(txn_id)['writes']), [0, 1])
+        self.assertEqual("".join(log.readWrites(txn_id, [0, 1])),
+                         "hello world")
+
+    def test_commit_frame(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.addWrite(txn_id, 1, "\r\nworld")
+        log.addWrite(txn_id, 0, "hello")
+        log.addWrite(txn_id, 2, "not committed")
+        frame = log.exportCommit(txn_id, 2)
+        log.discard(txn_id)
+
+        other = os.path.join(self.logdir, "other")
+        os.makedirs(other)
+        log = TransactionLog(other)
+        log.restoreCommit(txn_id, frame)
+        self.assertEqual(log.get(txn_id)['file'], "test.txt")
+        self.assertEqual("".join(log.readWrites(txn_id, [0, 1])),
+                         "hello\r\nworld")
+        self.assertRaises(Exception, log.restoreCommit, txn_id, frame[:-1])
+
+    def test_group_commit(self):
+        log = TransactionLog(self.logdir, group_window=10, group_size=2)
+        self.addCleanup(log.close)
+        txn_id = log.newTxn("test.txt")
+        first = log.sync()
+        self.assertFalse(first.called)
+        log.commit(txn_id, 0)
+        second = log.sync()  # The group is full
+        self.assertTrue(first.called and second.called)
+
+        # A failed fsync fails the waiting syncs, rather than leaving them
+        def fsync(fd):
+            raise OSError(5, "Input/output error")
+        self.patch(os, 'fsync', fsync)
+        log.abort(log.newTxn("other.txt"))
+        return self.assertFailure(log.sync(), Exception)
+
+    def test_open_index(self):
+        log = TransactionLog(self.logdir)
+        old = log.newTxn("a.txt", start_time=100)
+        new = log.newTxn("b.txt", start_time=300)
+        done = log.newTxn("c.txt", start_time=50)
+        log.commit(done, 0)
+        self.assertEqual(log.openTxns(), [old, new])
+        self.assertEqual(log.openTxns(started_before=200), [old])
+        self.assertEqual(log.openTxns(limit=1), [old])
+        log.abort(old)
+        log.close()
+
+        log = TransactionLog(self.logdir)
+        self.assertEqual(log.openTxns(), [new])
+        self.assertEqual(log.newTxn("d.txt"), done + 1)
+
+    def test_torn_record(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.close()
+        with open(log.segmentPath(log.segment), 'ab') as f:
+            f.write("\x00\x01")
+
+        log = TransactionLog(self.logdir)
+        self.assertEqual(log.get(txn_id)['status'], 'NEW_TXN')
+        log.abort(txn_id)
+        log.close()
+        self.assertEqual(TransactionLog(self.logdir).get(txn_id)['status'],
+                         'ABORT')
+
+    def test_damaged_record(self):
+        log = TransactionLog(self.logdir)
+        txn_id = log.newTxn("test.txt")
+        log.commit(txn_id, 0)
+        log.close()
+        # Damage before the last record isn't a torn tail
+        path = log.segmentPath(log.segment)
+        with open(path, 'r+b') as f:
+            f.seek(log.header.size)
+            f.write("X")
+        self.assertRaises(IOError, TransactionLog, self.logdir)
+
+    def test_damaged_segment(self):
+        log = TransactionLog(self.logdir)
+        log.segment_size = 1  # One record per segment
+        first = log.newTxn("test.txt")
+        log.commit(first, 0)
+        log.close()
+        # A torn record is only dropped from the last segment
+        path = log.segmentPath(log.segments()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertRaises(IOError, TransactionLog, self.logdir)
+
+    def test_catch_up(self):
+        log = TransactionLog(self.logdir)
+        first = log.newTxn("test.txt")
+        log.commit(first, 0)
+        (since, records) = log.catchUp(None)
+        self.assertEqual(len(list(records)), 1)
+
+        second = log.newTxn("other.txt")
+        log.abort(second)
+        log.close()
+
+        log = TransactionLog(self.logdir)
+        (position, records) = log.catchUp(since)
+        records = list(records)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][:8], "\x00" * 7 + chr(second))
+        self.assertEqual(position[0], since[0])
+        # A position from another log gets everything
+        (position, records) = log.catchUp(("other", 1, 0))
+        self.assertEqual(len(list(records)), 2)
+
+    def test_snapshot(self):
+        log = TransactionLog(self.logdir)
+        done = log.newTxn("test.txt")
+        log.addWrite(done, 0, "hello")
+        log.commit(done, 1)
+        open_id = log.newTxn("other.txt")
+        log.addWrite(open_id, 0, "world")
+        (since, __) = log.catchUp(None)
+
+        def check(_):
+            self.assertEqual(log.segments(), [2])
+            self.assertEqual(log.get(done)['writes'], {})
+            log.abort(open_id)
+            log.close()
+
+            replayed = TransactionLog(self.logdir)
+            self.assertEqual(replayed.get(done)['status'], 'COMMIT')
+            self.assertEqual(replayed.get(done)['writes_committed'], 1)
+            self.assertEqual(replayed.get(open_id)['status'], 'ABORT')
+            (__, records) = replayed.catchUp(since)
+            self.assertEqual(len(list(records)), 1)
+        return log.snapshot().addCallback(check)
+
+    def test_incremental_snapshot(self):
+        log = TransactionLog(self.logdir)
+        first = log.newTxn("test.txt")
+        log.commit(first, 0)
+        open_id = log.newTxn("open.txt")
+
+        def second(_):
+            # Only what finished since is added to the copied snapshot
+            self.assertEqual(log.snapshot_finished, 1)
+            size = log.snapshot_bytes
+            log.txns[first] = {}  # Not looked at again, it is copied
+            other = log.newTxn("other.txt")
+            log.abort(other)
+            return log.snapshot().addCallback(check, size, other)
+
+        def check(_, size, other):
+            self.assertEqual(log.snapshot_finished, 2)
+            self.assertTrue(log.snapshot_bytes > size)
+            log.close()
+            # A snapshot cut short by a crash is removed on startup
+            tmp = log.snapshotPath(log.snapshot_segment + 1) + ".tmp"
+            open(tmp, 'wb').close()
+
+            replayed = TransactionLog(self.logdir)
+            self.assertFalse(os.path.exists(tmp))
+            self.assertEqual(replayed.get(first)['status'], 'COMMIT')
+            self.assertEqual(replayed.get(other)['status'], 'ABORT')
+            self.assertEqual(replayed.get(open_id)['status'], 'NEW_TXN')
+            self.assertEqual(replayed.snapshot_finished, 2)
+        return log.snapshot().addCallback(second)
+
+
+class LockManagerTestCase(unittest.TestCase):
+
+    def test_fifo(self):
+        locks = LockManager()
+        order = []
+        for i in range(3):
+            locks.acquire("test.txt").addCallback(lambda _, i=i: order.append(i))
+        self.assertEqual(order, [0])
+        self.assertEqual(locks.depth("test.txt"), 3)
+        self.assertEqual(locks.depth("other.txt"), 0)
+
+        locks.release("test.txt")
+        locks.release("test.txt")
+        self.assertEqual(order, [0, 1, 2])
+        locks.release("test.txt")
+        self.assertEqual(locks.depths(), {})
+
+
+class ReplicationLagTestCase(unittest.TestCase):
+
+    def test_limits(self):
+        lag = ReplicationLag(1, 100)
+        released = []
+        lag.add(10)
+        lag.wait().addCallback(released.append)
+        lag.add(10)
+        lag.wait().addCallback(released.append)
+        lag.add(200)
+        lag.wait().addCallback(released.append)
+        self.assertEqual(len(released), 1)
+        self.assertEqual(lag.stats(), {'txns': 3, 'bytes': 220, 'waiting': 2})
+
+        lag.done(10)
+        self.assertEqual(len(released), 1)  # Still over the byte limit
+        lag.done(200)
+        self.assertEqual(len(released), 3)
+
+
+class ReadCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = ReadCache(10)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        self.assertEqual(cache.get("a"), "aaaa")
+        cache.put("c", "cccc")  # Evicts b, used least recently
+        self.assertEqual(cache.get("b"), None)
+        cache.put("d", "d" * 11)  # Too big to keep
+        cache.invalidate("a")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats(), {'bytes': 4, 'files': 1, 'hits': 1,
+                                         'misses': 2, 'evictions': 1})
+
+        self.assertEqual(ReadCache(0).get("a"), None)
+        self.assertFalse(ReadCache(0).fits(0))
+
+
+class DeltaTestCase(unittest.TestCase):
+
+    def test_appended(self):
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write("a" * 10 + "b" * 5)
+        blocks = blockSums(path, 'md5', 4)
+        self.assertEqual(fileDelta(path, blocks, 'md5', 4), [])
+
+        # Change a byte in the second block and append to the last
+        with open(path, 'wb') as f:
+            f.write("a" * 4 + "X" + "a" * 5 + "b" * 9)
+        self.assertEqual(fileDelta(path, blocks, 'md5', 4),
+                         [[4, 4], [12, 7]])
+
+        # Only the bytes appended after the copy's short last block
+        with open(path, 'wb') as f:
+            f.write("a" * 10 + "b" * 5 + "c" * 3)
+        self.assertEqual(fileDelta(path, blocks, 'md5', 4, other_size=15),
+                         [[15, 3]])
+        self.assertEqual(fileDelta(path, blocks, 'md5', 4, size=15,
+                                   other_size=15), [])
+
+
+class SplitBatchTestCase(unittest.TestCase):
+
+    def test_split(self):
+        body = "0 5\r\nhello2 7\r\n\r\nworld"
+        self.assertEqual(splitBatch(body), [(0, "hello"), (2, "\r\nworld")])
+        self.assertEqual(splitBatch(""), [])
+        self.assertRaises(Exception, splitBatch, body[:-1])
+        self.assertRaises(Exception, splitBatch, "0 5")
+
+
+class TestService(FilesystemService):
+    """ Skips the startup, which needs primary.txt and the network. """
+
+    def __init__(self):
+        pass
+
+
+def makeService(test):
+    """
+    Returns a primary for test, in a new directory made the current one
+    until the test is done.
+    """
+    path = os.path.abspath(test.mktemp())
+    os.makedirs(os.path.join(path, FilesystemService.logdir))
+    test.addCleanup(os.chdir, os.getcwd())
+    os.chdir(path)
+
+    service = TestService()
+    service.role = 'PRIMARY'
+    service.txn_list = TransactionLog(service.logdir)
+    test.addCleanup(service.txn_list.close)
+    service.commit_locks = LockManager()
+    service.read_cache = ReadCache(1024)
+    service.streamed = {}
+    service.channels = set()
+    service.file_list = {}
+    service.file_stats = {}
+    service.hashers = {}
+    for name in ("hash", "commit"):
+        pool = ThreadPool(1, 2, name)
+        pool.start()
+        test.addCleanup(pool.stop)
+        setattr(service, name + "_pool", pool)
+    return service
+
+
+class FilesystemProtocolTestCase(unittest.TestCase):
+    _keep_alive = "KEEP_ALIVE 0 0 0\r\n\r\n\r\n"
+    _ack = "ACK 0 0 0 0\r\n\r\n\r\n"
+
+    def setUp(self):
+        self.service = makeService(self)
+        self.factory = protocol.ServerFactory()
+        self.factory.protocol = FilesystemProtocol
+        self.factory.service = self.service
+        with open("a.txt", 'wb') as f:
+            f.write("hello world")
+
+    def _send(self, msg):
+        """ Returns what the server sent back to msg, on a new connection. """
+        proto = self.factory.buildProtocol(('127.0.0.1', 1234))
+        tr = proto_helpers.StringTransport()
+        proto.makeConnection(tr)
+        self.addCleanup(proto.connectionLost, "Done test")
+        proto.dataReceived(msg)
+        # READ streams the file as the transport asks for more
+        while tr.producer is not None:
+            tr.producer.resumeProducing()
+        self.tr = tr
+        return tr.value()
+
+    def _read(self, body, seq=0):
+        return "READ 0 %d %d\r\n\r\n%s\r\n" % (seq, len(body), body)
+
+    def test_read_range(self):
+        self.service.read_cache = ReadCache(0)  # From the file itself
+        self.assertEqual(self._send(self._read("a.txt\r\n6")), "world")
+        self.assertEqual(self._send(self._read("a.txt\r\n2 3")), "llo")
+        self.assertEqual(self._send(self._read("a.txt\r\n6 100")), "world")
+        self.assertEqual(self._send(self._read("a.txt\r\n100")), "")
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_keep_alive_read_range(self):
+        # The header has the length of the range actually sent
+        reply = self._send(self._keep_alive + self._read("a.txt\r\n6", 1) +
+                           self._read("a.txt\r\n2 3", 2) +
+                           self._read("a.txt\r\n100", 3) +
+                           self._read("a.txt\r\n-1", 4))
+        err = "Range must not be negative."
+        self.assertEqual(reply, self._ack +
+                         "READ 0 1 0 5\r\n\r\nworld\r\n" +
+                         "READ 0 2 0 3\r\n\r\nllo\r\n" +
+                         "READ 0 3 0 0\r\n\r\n\r\n" +
+                         "ERROR 0 4 204 %d\r\n\r\n%s\r\n\r\n" % (len(err), err))
+        self.assertFalse(self.tr.disconnecting)
+
+    def test_keep_alive_sync_log(self):
+        reply = self._send(self._keep_alive + "SYNC_LOG 0 3 0\r\n\r\n\r\n")
+        err = "SYNC_LOG needs a connection of its own."
+        self.assertEqual(reply, self._ack +
+                         "ERROR 0 3 204 %d\r\n\r\n%s\r\n\r\n" % (len(err), err))
+        self.assertFalse(self.tr.disconnecting)
+
+
+class FilesystemServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.service = makeService(self)
+
+    def test_block_index(self):
+        with open("a.txt", 'wb') as f:
+            f.write("hello")
+        self.service.hashFiles()
+
+        def check(index, size):
+            self.assertEqual(index['a.txt']['size'], size)
+            self.assertEqual(index['a.txt']['blocks'], blockSums(
+                "a.txt", 'md5', FilesystemService.sync_block_size))
+
+        def unchanged(index):
+            # Kept in the hash index, so not read again after a restart
+            self.service.hashFiles()
+            self.patch(server, 'blockSums', None)
+            return self.service.blockIndex()
+
+        def appended(index):
+            self.patch(server, 'blockSums', blockSums)
+            with open("a.txt", 'ab') as f:
+                f.write(" world")
+            return self.service.blockIndex()
+
+        d = self.service.blockIndex()
+        d.addCallback(check, 5)
+        d.addCallback(unchanged)
+        d.addCallback(check, 5)
+        d.addCallback(appended)
+        d.addCallback(check, 11)
+        return d
+
+    def test_async_lag(self):
+        service = self.service
+        service.secondary = ('127.0.0.1', 0)
+        service.replication_mode = 'async'
+        service.lag = ReplicationLag(0, 1024)
+        first = service.txn_list.newTxn("a.txt")
+        service.txn_list.addWrite(first, 0, "hello ")
+        second = service.txn_list.newTxn("a.txt")
+        service.txn_list.addWrite(second, 0, "world")
+
+        sent = []
+        both = defer.Deferred()
+        def replicateCommit(txn_id, seq, extents, discard=False):
+            sent.append(defer.Deferred())
+            if len(sent) == 2:
+                both.callback(None)
+            return sent[-1]
+        service.replicateCommit = replicateCommit
+
+        def replicated(_):
+            # The first waits for the secondary without holding the file
+            self.assertFalse(commits[0].called)
+            with open("a.txt", 'rb') as f:
+                self.assertEqual(f.read(), "hello world")
+            for d in sent:
+                d.callback(None)
+            return defer.gatherResults(commits)
+
+        commits = [service.commitTxn(first, 1), service.commitTxn(second, 1)]
+        both.addCallback(replicated)
+        both.addCallback(self.assertEqual, [('ACK', None)] * 2)
+        return both
+
+    def test_abort_unknown(self):
+        # The primary may abort a transaction it never streamed here
+        service = self.service
+        service.role = 'SECONDARY'
+        offset = service.txn_list.offset
+        d = service.writeLog('ABORT', 42, 0, "")
+        d.addCallback(self.assertEqual, ('ACK', None))
+        d.addCallback(lambda _: self.assertFalse(42 in service.txn_list))
+        d.addCallback(lambda _: self.assertEqual(service.txn_list.offset,
+                                                 offset))
+        return d
+
+    def test_resync(self):
+        service = self.service
+        service.role = 'SECONDARY'
+        service.primary = ('127.0.0.1', 0)
+        service.secondary_reads = True
+        service.synced = True
+        service.channels.add(self)
+        with open("a.txt", 'wb') as f:
+            f.write("hello")
+        service.hashFiles()
+        self.assertEqual(service.readFile("a.txt")[1].read(), "hello")
+
+        # Replication stopped, and the primary committed meanwhile
+        service.synced = False
+        primary = {"a.txt": "hello world", "b.txt": "new"}
+        files = {"a.txt": [11, [[5, 6]]], "b.txt": [3, [[0, 3]]]}
+
+        class Fetch():
+            """ Writes what FetchProtocol would have fetched. """
+            def __init__(self, reactor, protocol, fname, path, offset, length):
+                self.args = (fname, path, offset, length)
+
+            def connectTCP(self, host, port):
+                (fname, path, offset, length) = self.args
+                with open(path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(primary[fname][offset:offset + length])
+                self.deferred = defer.succeed(length)
+                return defer.succeed(self)
+
+        class Announce():
+            def sendNEW_SEC(self, host, port, index):
+                return defer.succeed(json.dumps(files))
+
+        self.patch(server, 'ClientCreator', Fetch)
+        service.connectToServer = lambda primary: defer.succeed(Announce())
+        service.catchUp = lambda: defer.succeed(None)
+
+        def check(_):
+            self.assertTrue(service.synced)
+            # Not the copy cached before
+            self.assertEqual(service.readFile("a.txt")[1].read(),
+                             "hello world")
+            for (f, data) in primary.items():
+                self.assertEqual(service.file_list[f],
+                                 hashlib.md5(data).hexdigest())
+                self.assertEqual(service.file_stats[f], service.statFile(f))
+        return service.resync().addCallback(check)
+
+    def test_reap(self):
+        service = self.service
+        service.txn_ttl = 60
+        service.reap_batch = 2
+        log = service.txn_list
+        locked = log.newTxn("locked.txt", start_time=1)
+        expired = [log.newTxn("a.txt", start_time=t) for t in (2, 3, 4)]
+        recent = log.newTxn("b.txt")
+        service.commit_locks.acquire("locked.txt")
+
+        def statuses():
+            return [log.get(txn_id)['status']
+                    for txn_id in [locked] + expired + [recent]]
+
+        def first(_):
+            # The locked one doesn't count towards the batch
+            self.assertEqual(statuses(), ['NEW_TXN', 'ABORT', 'ABORT',
+                                          'NEW_TXN', 'NEW_TXN'])
+            return service.reapTxns()
+
+        def second(_):
+            self.assertEqual(statuses(), ['NEW_TXN', 'ABORT', 'ABORT',
+                                          'ABORT', 'NEW_TXN'])
+            service.commit_locks.release("locked.txt")
+            return service.reapTxns()
+
+        def third(_):
+            self.assertEqual(statuses(), ['ABORT'] * 4 + ['NEW_TXN'])
+            # A client's ABORT after the reaper's isn't logged again
+            finished = len(log.finished)
+            d = service.abortTxn(expired[0], 0)
+            d.addCallback(self.assertEqual, ('ACK', None))
+            d.addCallback(lambda _: self.assertEqual(len(log.finished),
+                                                     finished))
+            return d
+
+        d = service.reapTxns()
+        d.addCallback(first)
+        d.addCallback(second)
+        d.addCallback(third)
+        return d